@@ -0,0 +1,435 @@
+"""
+Micro-benchmarks for grocktx.  From the command line:
+    $ python -m grocktx.benchmark [--save FILE] [--compare FILE] [name ...]
+runs the named benchmarks (by default, all of them) and prints their timings,
+rates and the peak memory of each.  Each benchmark runs in a fresh process,
+so that it starts with cold caches and its peak memory is its own.
+
+``--save`` writes the results to a JSON file, and ``--compare`` compares
+them against such a file, exiting with status 1 if any rate has dropped by
+more than ``--tolerance`` percent (or if any benchmark failed).
+
+The parser benchmarks run on a synthetic corpus (see ``corpus``) of memos in
+the mix of a typical checking account, at real cities and zips from
+``data/zips.csv``.  It is generated from a fixed seed, so results are
+comparable from run to run.
+"""
+import sys
+import csv
+import json
+import random
+import timeit
+import resource
+import datetime
+import optparse
+import multiprocessing
+
+import parser
+import zipdata
+
+def _strptime_pos_date(date_time_str, target):
+    """ ``parser.parse_pos_date`` as it was, with strptime, for comparison. """
+    date = datetime.datetime.strptime("%s %s" % (
+            target.year,
+            date_time_str),
+        "%Y %m%d %H%M")
+    diff = date - target
+    if abs(diff) > datetime.timedelta(180):
+        if diff < datetime.timedelta(0):
+            date = datetime.datetime(date.year + 1, date.month, date.day,
+                    date.hour, date.minute)
+        else:
+            date = datetime.datetime(date.year - 1, date.month, date.day,
+                    date.hour, date.minute)
+    return date.strftime("%Y-%m-%d"), date.strftime("%H:%M")
+
+def _fast_pos_date(date_time_str, target):
+    date = parser.parse_pos_date(date_time_str, target)
+    return parser._format_date(date), "%02d:%02d" % (date.hour, date.minute)
+
+def _strptime_cc_date(date_str):
+    date = datetime.datetime.strptime(date_str, "%m-%d-%y")
+    return date.strftime("%Y-%m-%d")
+
+def bench_dates(number=100000):
+    """ POS/ATM and credit card date parsing: strptime vs. slicing. """
+    target = datetime.datetime(2010, 1, 1)
+    pos_dates = ["1128 1756", "0302 1404", "1231 2359", "0101 0000"]
+    cc_dates = ["11-25-09", "03-21-10", "12-31-99", "01-01-00"]
+    cases = (
+        ("pos date, strptime", lambda: [_strptime_pos_date(d, target)
+                                        for d in pos_dates]),
+        ("pos date, sliced", lambda: [_fast_pos_date(d, target)
+                                      for d in pos_dates]),
+        ("cc date, strptime", lambda: [_strptime_cc_date(d)
+                                       for d in cc_dates]),
+        ("cc date, sliced", lambda: [parser.parse_cc_date(d)
+                                     for d in cc_dates]),
+    )
+    results = []
+    for label, func in cases:
+        seconds = min(timeit.repeat(func, repeat=3, number=number // 4))
+        results.append((label, seconds, number / seconds))
+    return results
+
+WESABE_TXACTION = """  <txaction>
+    <guid>%(guid)s</guid>
+    <account-id type="integer">1</account-id>
+    <date type="date">2009-11-30</date>
+    <original-date type="date">2009-11-28</original-date>
+    <amount type="float">-%(amount)s</amount>
+    <display-name>Harvest Co-op &amp; Market</display-name>
+    <raw-name>WITHDRAW</raw-name>
+    <raw-txntype>DEBIT</raw-txntype>
+    <memo>POS 1128 1756 %(auth)06d HARVEST COOP CAMBRIDGE MA</memo>
+    <merchant>
+      <id type="integer">42</id>
+      <name>Harvest Co-op</name>
+    </merchant>
+    <tags>
+      <tag><name>food</name></tag>
+    </tags>
+  </txaction>
+"""
+
+def wesabe_export(count):
+    """ A synthetic Wesabe XML export of ``count`` transactions. """
+    return "".join(["<?xml version=\"1.0\"?>\n<txactions>\n"] +
+        [WESABE_TXACTION % {'guid': "%040x" % i, 'amount': i % 10000 / 100.0,
+                            'auth': i % 1000000}
+         for i in xrange(count)] +
+        ["</txactions>\n"])
+
+def bench_wesabe(count=100000, chunksize=65536):
+    """ Wesabe XML export, streamed through iter_parse, with and without memos. """
+    import scraper
+    xml = wesabe_export(count)
+
+    def run(parse_memos):
+        wesabe = scraper.WesabeScraper(parse_memos=parse_memos)
+        chunks = (xml[i:i + chunksize] for i in xrange(0, len(xml), chunksize))
+        for tx in wesabe.iter_parse(chunks):
+            pass
+
+    results = []
+    for label, parse_memos in (("XML only", False), ("with memos", True)):
+        seconds = min(timeit.repeat(lambda: run(parse_memos), repeat=1,
+                                    number=1))
+        results.append(("%d txactions, %s" % (count, label), seconds,
+                        count / seconds))
+    return results
+
+MINT_ROW = ('"%(month)02d/%(day)02d/2009","Harvest Co-op",'
+            '"POS %(month)02d%(day)02d 1756 %(auth)06d HARVEST COOP CAMBRIDGE MA",'
+            '"%(amount)s","debit","Groceries","Checking","",""\n')
+
+def mint_export(count):
+    """ The lines of a synthetic mint.com CSV dump of ``count`` rows. """
+    return (['"Date","Description","Original Description","Amount",'
+             '"Transaction Type","Category","Account Name","Labels","Notes"\n'] +
+        [MINT_ROW % {'month': i % 12 + 1, 'day': i % 28 + 1,
+                     'amount': i % 10000 / 100.0, 'auth': i % 1000000}
+         for i in xrange(count)])
+
+def bench_mint(count=100000):
+    """ mint.com CSV dump: a csv reader per line vs. one reader. """
+    import scraper
+    lines = mint_export(count)
+    mint = scraper.MintScraper()
+
+    def per_line():
+        for line in lines[1:]:
+            mint.parse(line)
+
+    def one_reader():
+        for tx in mint.iter_parse(lines):
+            pass
+
+    results = []
+    for label, func in (("per line", per_line), ("one reader", one_reader)):
+        seconds = min(timeit.repeat(func, repeat=1, number=1))
+        results.append(("%d rows, %s" % (count, label), seconds,
+                        count / seconds))
+    return results
+
+VENDORS = ("HARVEST COOP", "SAVENORS MARKET", "THE HOME DEPOT 332",
+           "DADDY.S JUNKY MUSIC #6", "BROADWAY BICYCLE SCHOO", "CVS 0123",
+           "SHELL OIL 57442", "STOP & SHOP 0412", "STARBUCKS #1093",
+           "WHOLE FOODS MKT", "DUNKIN #3366", "TRADER JOE.S #512",
+           "BANK OF AMERICA", "CITIZENS BANK", "AMC LOEWS 3452", "SUBWAY 3021")
+CARD_VENDORS = ("PAYPAL *NFSN INC", "AMAZON MKTPLACE PMTS", "NETFLIX.COM",
+                "CARBON FUND.ORG", "ITUNES.COM/BILL", "COMCAST CABLE")
+
+def _abbreviate(city, rand):
+    """ Squash or truncate ``city`` the way bank memos do, sometimes. """
+    if rand.random() < 0.2:
+        city = city.replace(" ", "")
+    if rand.random() < 0.3 and len(city) > 4:
+        city = city[:rand.randint(4, len(city))]
+    return city
+
+def corpus(count, seed=0):
+    """
+    A synthetic corpus of ``count`` (memo, date) pairs: POS purchases, ATM
+    withdrawals and credit card purchases at real cities and zips from
+    ``data/zips.csv``, with checks, transfers, deposits, dividends and fees
+    mixed in, in roughly the proportions of a checking account.
+    """
+    rand = random.Random(seed)
+    with open(zipdata.ZipData.ZIP_CITY_DATA, 'rb') as file:
+        places = list(csv.reader(file))
+    end = datetime.datetime(2010, 1, 1)
+    memos = []
+    for i in xrange(count):
+        date = end - datetime.timedelta(rand.randint(0, 365))
+        auth_date = date - datetime.timedelta(rand.randint(0, 3))
+        zip, city, state = rand.choice(places)
+        vendor = rand.choice(VENDORS)
+        kind = rand.random()
+        if kind < 0.35:
+            memo = "WITHDRAW#  - POS %s %s %06d %s %s %s" % (
+                    auth_date.strftime("%m%d"), "%02d%02d" % (
+                    rand.randint(0, 23), rand.randint(0, 59)),
+                    rand.randint(0, 999999), vendor,
+                    _abbreviate(city, rand), state)
+        elif kind < 0.45:
+            memo = "WITHDRAW /  ATM %s %02d%02d %06d %s %s %s" % (
+                    auth_date.strftime("%m%d"), rand.randint(0, 23),
+                    rand.randint(0, 59), rand.randint(0, 999999), vendor,
+                    zip if rand.random() < 0.3 else _abbreviate(city, rand),
+                    state)
+        elif kind < 0.65:
+            if rand.random() < 0.2:
+                place = "%s %03d-%03d-%04d" % (rand.choice(CARD_VENDORS),
+                        rand.randint(200, 999), rand.randint(200, 999),
+                        rand.randint(0, 9999))
+            else:
+                place = "%s %s" % (vendor, _abbreviate(city, rand))
+            memo = "PURCHASE#  - %s %s%s auth# %05d" % (
+                    auth_date.strftime("%m-%d-%y"), place,
+                    state if rand.random() < 0.3 else " " + state,
+                    rand.randint(0, 99999))
+        elif kind < 0.75:
+            memo = "SH DRAFT# %d" % rand.randint(100, 9999)
+        elif kind < 0.82:
+            memo = rand.choice(["TRANSFER", "Transfer"]) + \
+                    " 000%07d / %s" % (rand.randint(0, 9999999),
+                    rand.choice(["ONLINE TRANSFER", "Savings", "MORTGAGE"]))
+        elif kind < 0.89:
+            memo = rand.choice(["DEPOSIT", "DEPOSIT#  - MASS. INST. OF "
+                                "TPAYROLL", "DEPOSIT /  MOBILE DEPOSIT"])
+        elif kind < 0.92:
+            memo = rand.choice(["DIVIDEND#", "Savings / DIVIDEND"])
+        elif kind < 0.97:
+            memo = rand.choice([
+                "FEE / INTERNATIONAL TRANSACTION PROCESSING FEE $%d.%02d",
+                "FEE / CURRENCY CONVERSION FEE $%d.%02d",
+                "REV FEE#  - ATM SURCHARGE FEE REIMBURSEMENT $-%d.%02d"]) % (
+                rand.randint(0, 3), rand.randint(0, 99))
+        else:
+            memo = rand.choice(["WITHDRAW#  - ebill epayment %s" % vendor,
+                                "CHECKCARD %s" % vendor])
+        memos.append((memo, date))
+    return memos
+
+def _time(func, repeat=5, minimum=0.2):
+    """
+    The best time per call of ``func`` over ``repeat`` samples, each of
+    enough calls to take at least ``minimum`` seconds, so that short
+    benchmarks are not at the mercy of the timer and scheduler.
+    """
+    number = 1
+    seconds = timeit.timeit(func, number=number)
+    while seconds < minimum:
+        number *= 2
+        seconds = timeit.timeit(func, number=number)
+    samples = [seconds] + timeit.repeat(func, repeat=repeat - 1,
+                                        number=number)
+    return min(samples) / number
+
+def bench_parse(count=5000):
+    """ parser.parse on the synthetic corpus, with cold and warm caches. """
+    memos = corpus(count)
+    zipdata.zip_data()
+
+    def run():
+        for memo, date in memos:
+            parser.parse(memo, date)
+
+    def cold():
+        parser.memo_cache.clear()
+        parser.vendor_cache.clear()
+        run()
+
+    caches = (parser.memo_cache, parser.vendor_cache)
+    sizes = [cache.maxsize for cache in caches]
+    results = []
+    try:
+        seconds = _time(cold)
+        results.append(("%d memos, cold caches" % count, seconds,
+                        count / seconds))
+        # Warm: every memo is already in the cache.
+        for cache in caches:
+            cache.resize(max(cache.maxsize, count))
+        run()
+        seconds = _time(run)
+        results.append(("%d memos, warm caches" % count, seconds,
+                        count / seconds))
+    finally:
+        for cache, size in zip(caches, sizes):
+            cache.resize(size)
+    return results
+
+def _vendors(count):
+    """ The vendor descriptions of the purchases and withdrawals in a corpus. """
+    vendors = []
+    for memo, date in corpus(count):
+        for regex in (parser.pos_re, parser.atm_re, parser.credit_card_re):
+            match = regex.match(memo)
+            if match:
+                vendors.append(match.group('description'))
+                break
+    return vendors
+
+def bench_parse_vendor(count=5000):
+    """ parser.parse_vendor on the corpus' vendor descriptions, uncached. """
+    vendors = _vendors(count)
+    zipdata.zip_data()
+    maxsize = parser.vendor_cache.maxsize
+    parser.vendor_cache.resize(0)
+    try:
+        seconds = _time(lambda: [parser.parse_vendor(vendor)
+                                 for vendor in vendors])
+    finally:
+        parser.vendor_cache.resize(maxsize)
+    return [("%d vendors" % len(vendors), seconds, len(vendors) / seconds)]
+
+def bench_parse_city(count=5000):
+    """ parser.parse_city on the corpus' vendors, against their state. """
+    zips = zipdata.zip_data()
+    cases = []
+    for vendor in _vendors(count):
+        cities = zips.city_index(vendor[-2:])
+        if cities:
+            cases.append((cities, vendor[:-2].strip()))
+    seconds = _time(lambda: [parser.parse_city(cities, stub)
+                             for cities, stub in cases])
+    return [("%d city stubs" % len(cases), seconds, len(cases) / seconds)]
+
+def bench_zipdata():
+    """ Loading the zip tables: from the csv, the marshal cache and mmap. """
+    # Make sure the cache and map files exist before timing them.
+    zipdata.ZipData()
+    zipdata.MappedZipData()
+    cases = (
+        ("ZipData, csv", lambda: zipdata.ZipData(use_cache=False)),
+        ("ZipData, marshal cache", zipdata.ZipData),
+        ("MappedZipData", zipdata.MappedZipData),
+    )
+    results = []
+    for label, func in cases:
+        seconds = _time(func)
+        results.append((label, seconds, 1 / seconds))
+    return results
+
+BENCHMARKS = {
+    'dates': bench_dates,
+    'mint': bench_mint,
+    'parse': bench_parse,
+    'parse_city': bench_parse_city,
+    'parse_vendor': bench_parse_vendor,
+    'wesabe': bench_wesabe,
+    'zipdata': bench_zipdata,
+}
+
+def _run_child(name, conn):
+    try:
+        results = BENCHMARKS[name]()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        conn.send((results, peak, None))
+    except Exception, e:
+        conn.send((None, None, "%s: %s" % (e.__class__.__name__, e)))
+    conn.close()
+
+def run(name):
+    """
+    Run benchmark ``name`` in a child process.  Returns its list of (label,
+    seconds, rate) results and its peak resident memory in MB; raises
+    RuntimeError if the benchmark fails or its process dies.
+    """
+    parent, child = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_run_child, args=(name, child))
+    process.start()
+    # Only the child may hold the sending end, so that recv() sees EOF
+    # rather than waiting forever if the child dies without sending.
+    child.close()
+    try:
+        results, peak, error = parent.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError("benchmark %s failed: its process died (exit "
+                           "code %s)" % (name, process.exitcode))
+    finally:
+        parent.close()
+    process.join()
+    if error:
+        raise RuntimeError("benchmark %s failed: %s" % (name, error))
+    return results, peak
+
+def main(argv=None):
+    usage = "usage: %prog [options] [name ...]"
+    opts = optparse.OptionParser(usage=usage, description="Run the named "
+            "benchmarks (by default, all of them): %s." % ", ".join(
+            sorted(BENCHMARKS.keys())))
+    opts.add_option("--save", metavar="FILE",
+            help="write the results to FILE as JSON")
+    opts.add_option("--compare", metavar="FILE",
+            help="compare the results with a baseline saved by --save")
+    opts.add_option("--tolerance", type="float", default=20.0,
+            help="the drop in rate, in percent, taken for a regression "
+                 "(default: 20)")
+    options, names = opts.parse_args(argv)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        opts.error("unknown benchmarks: %s" % ", ".join(unknown))
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+
+    saved = {}
+    regressions = []
+    failures = []
+    for name in names or sorted(BENCHMARKS.keys()):
+        try:
+            results, peak = run(name)
+        except RuntimeError, e:
+            print "%s: FAILED: %s" % (name, e)
+            failures.append(name)
+            continue
+        print "%s: %s (peak %.1f MB)" % (name,
+                BENCHMARKS[name].__doc__.strip(), peak)
+        saved[name] = {'peak_mb': peak, 'results': {}}
+        before = baseline.get(name, {}).get('results', {})
+        for label, seconds, rate in results:
+            saved[name]['results'][label] = {'seconds': seconds, 'rate': rate}
+            line = "    %-30s %8.3fs %12.0f/s" % (label, seconds, rate)
+            if label in before:
+                change = 100.0 * (rate / before[label]['rate'] - 1)
+                line += " %+7.1f%%" % change
+                if change < -options.tolerance:
+                    line += " REGRESSION"
+                    regressions.append("%s: %s" % (name, label))
+            print line
+    if options.save:
+        with open(options.save, 'w') as file:
+            json.dump(saved, file, indent=4, sort_keys=True)
+    if failures:
+        sys.stderr.write("Failed: %s\n" % ", ".join(failures))
+    if regressions:
+        sys.stderr.write("Regressions: %s\n" % "; ".join(regressions))
+    if failures or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,407 @@
 import json
+import time
+import errno
+import sqlite3
+import socket
 import urllib
 import urllib2
+import httplib
+import urlparse
+import threading
+import collections
+import Queue
+from StringIO import StringIO
 
 SERVER = "https://grocktx.media.mit.edu/"
 grocktx_username = "admin"
 grocktx_password = "admin"
 USER_AGENT = "Example client"
+# Set to a file name to cache find_params results on disk (see TagCache).
+CACHE_PATH = None
+
+def _normalize(value):
+    """
+    ``value`` with the spacing and case of strings, and empty fields, made
+    uniform, so that equivalent vendor queries share a cache entry.
+    """
+    if isinstance(value, dict):
+        return dict((key, _normalize(v)) for key, v in value.iteritems()
+                    if v not in (None, ""))
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, basestring):
+        return " ".join(value.split()).upper()
+    return value
+
+class TagCache(object):
+    """
+    A persistent cache of tag lookups in the SQLite file at ``path``, keyed
+    on the normalized query.  Results are kept for ``ttl`` seconds; misses
+    (results that are an empty JSON value, i.e. no tags) are cached too, for
+    ``negative_ttl`` seconds.  Beyond ``maxsize`` entries, those closest to
+    expiring are evicted.
+    """
+    def __init__(self, path, ttl=7 * 86400, negative_ttl=86400,
+                 maxsize=100000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.clock = time.time
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS tag_cache ("
+                "key TEXT PRIMARY KEY, result TEXT, negative INTEGER, "
+                "expires REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tag_cache_expires "
+                "ON tag_cache (expires)")
+        self.db.commit()
+        # Kept up to date by this object, so that puts needn't count rows.
+        self.size = self.db.execute("SELECT COUNT(*) FROM tag_cache"
+                                    ).fetchone()[0]
+        self.hits = self.negative_hits = self.misses = 0
+        self.expired = self.evictions = 0
+
+    def key(self, params):
+        return json.dumps(_normalize(params), sort_keys=True)
+
+    def get(self, params):
+        """ The cached result for ``params``, or None. """
+        key = self.key(params)
+        with self.lock:
+            row = self.db.execute("SELECT result, negative, expires "
+                    "FROM tag_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            result, negative, expires = row
+            if expires <= self.clock():
+                self.size -= self.db.execute("DELETE FROM tag_cache "
+                        "WHERE key = ?", (key,)).rowcount
+                self.db.commit()
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.negative_hits += negative
+            return result.encode("utf-8")
+
+    def put(self, params, result):
+        try:
+            negative = not json.loads(result)
+        except ValueError:
+            negative = False
+        ttl = self.negative_ttl if negative else self.ttl
+        row = (result.decode("utf-8"), negative, self.clock() + ttl,
+               self.key(params))
+        with self.lock:
+            if not self.db.execute("UPDATE tag_cache SET result = ?, "
+                    "negative = ?, expires = ? WHERE key = ?", row).rowcount:
+                self.db.execute("INSERT INTO tag_cache "
+                        "(result, negative, expires, key) VALUES (?, ?, ?, ?)",
+                        row)
+                self.size += 1
+            excess = self.size - self.maxsize
+            if excess > 0:
+                evicted = self.db.execute("DELETE FROM tag_cache WHERE key IN ("
+                        "SELECT key FROM tag_cache ORDER BY expires LIMIT ?)",
+                        (excess,)).rowcount
+                self.size -= evicted
+                self.evictions += evicted
+            self.db.commit()
+
+    def invalidate(self, params):
+        with self.lock:
+            self.size -= self.db.execute("DELETE FROM tag_cache WHERE key = ?",
+                                         (self.key(params),)).rowcount
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM tag_cache")
+            self.db.commit()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': self.size,
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        self.db.close()
+
+def _closed_idle(error):
+    """
+    Whether ``error``, from a request on a kept-alive connection, means the
+    server had closed the connection before reading the request, so that it
+    is safe to send again.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        # Nothing at all came back.
+        return error.line == "''" or error.line.startswith("No status line")
+    if isinstance(error, socket.error):
+        return error.errno in (errno.ECONNRESET, errno.EPIPE)
+    return False
+
+class Client(object):
+    """
+    A client for the tagging server at ``server`` which keeps up to
+    ``connections`` keep-alive connections open and shares them between
+    threads.  Lookups that fail with a connection error or a 5xx response
+    are retried up to ``retries`` times, sleeping ``backoff``, then twice
+    that, and so on between attempts; other HTTP errors raise
+    urllib2.HTTPError as urlopen would.  Puts are not idempotent, so they
+    are only retried if the connection failed before the request was sent,
+    or if a kept-alive connection turns out to have been closed by the
+    server before it read the request.
+
+    ``find_many`` and ``put_many`` run many calls at once over the pool.  If
+    the server accepts a JSON list of queries (returning a list of results),
+    set ``batch_size`` to send up to that many lookups per request instead.
+    Lookups are answered from ``cache`` (a TagCache), if given, when they can
+    be.
+    """
+    def __init__(self, server=SERVER, connections=4, retries=3, backoff=0.5,
+                 timeout=30, user_agent=USER_AGENT, batch_size=None,
+                 cache=None):
+        self.server = server
+        url = urlparse.urlsplit(server)
+        if url.scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.host = url.netloc
+        self.path = (url.path or "/") + "tags/api"
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.batch_size = batch_size
+        self.cache = cache
+        self.idle = Queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=10000)
+        self.calls = self.retried = self.errors = 0
+
+    def _request(self, method, path, body=None):
+        headers = {'User-Agent': self.user_agent}
+        if body is not None:
+            headers['Content-Type'] = "application/x-www-form-urlencoded"
+        idempotent = method == "GET"
+        attempt = 0
+        start = time.time()
+        while True:
+            try:
+                conn, reused = self.idle.get_nowait(), True
+            except Queue.Empty:
+                conn, reused = self.connection_class(self.host,
+                        timeout=self.timeout), False
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused and (idempotent or not sent or _closed_idle(e)):
+                    # The server may have closed an idle connection; try
+                    # again straight away on a new one.
+                    continue
+                if sent and not idempotent:
+                    # The server may have acted on it; don't send it twice.
+                    error = e
+                    break
+                error = e
+            else:
+                if response.will_close:
+                    conn.close()
+                elif self.idle.qsize() < self.connections:
+                    self.idle.put(conn)
+                else:
+                    conn.close()
+                if response.status < 400:
+                    self._record(start, attempt)
+                    return data
+                error = urllib2.HTTPError(self.server + path.lstrip("/"),
+                        response.status, response.reason, response.msg,
+                        StringIO(data))
+                if response.status < 500 or not idempotent:
+                    break
+            if attempt >= self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+        self._record(start, attempt, failed=True)
+        raise error
+
+    def _record(self, start, retries, failed=False):
+        with self.lock:
+            self.latencies.append(time.time() - start)
+            self.calls += 1
+            self.retried += retries
+            self.errors += failed
+
+    def _find(self, params):
+        data = urllib.urlencode({'params': json.dumps(params)})
+        return self._request("GET", self.path + "?" + data)
+
+    def find(self, params):
+        """ As ``find_params``. """
+        if self.cache is not None:
+            result = self.cache.get(params)
+            if result is not None:
+                return result
+        result = self._find(params)
+        if self.cache is not None:
+            self.cache.put(params, result)
+        return result
+
+    def put(self, params):
+        """ As ``put_params``. """
+        data = urllib.urlencode({'params': json.dumps(params)})
+        return self._request("POST", self.path, data)
+
+    def _map(self, func, items):
+        """ ``map(func, items)``, on up to ``connections`` threads. """
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+        queue = Queue.Queue()
+        for job in enumerate(items):
+            queue.put(job)
+        def work():
+            while not errors:
+                try:
+                    index, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = func(item)
+                except Exception, e:
+                    errors.append(e)
+        threads = [threading.Thread(target=work)
+                   for i in xrange(min(self.connections, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def find_many(self, params_list):
+        """
+        The results of ``find`` for each of ``params_list``, in order.  Only
+        the queries not in the cache are sent, once each.
+        """
+        params_list = list(params_list)
+        results = [None] * len(params_list)
+        if self.cache is None:
+            missing = range(len(params_list))
+        else:
+            missing = []
+            pending = {}
+            for i, params in enumerate(params_list):
+                key = self.cache.key(params)
+                if key in pending:
+                    # The same vendor again: look it up only once.
+                    pending[key].append(i)
+                    continue
+                results[i] = self.cache.get(params)
+                if results[i] is None:
+                    pending[key] = [i]
+                    missing.append(i)
+        queries = [params_list[i] for i in missing]
+        if not self.batch_size:
+            found = self._map(self._find, queries)
+        else:
+            batches = [queries[i:i + self.batch_size]
+                       for i in xrange(0, len(queries), self.batch_size)]
+            found = []
+            for batch, response in zip(batches,
+                                       self._map(self._find, batches)):
+                response = json.loads(response)
+                if not isinstance(response, list) or \
+                        len(response) != len(batch):
+                    # Pairing them up anyway would cache wrong results.
+                    raise ValueError("Sent %d queries, got %s" % (len(batch),
+                            "%d results" % len(response)
+                            if isinstance(response, list) else "no list"))
+                found.extend(json.dumps(result) for result in response)
+        for i, result in zip(missing, found):
+            if self.cache is None:
+                results[i] = result
+            else:
+                self.cache.put(params_list[i], result)
+                for j in pending[self.cache.key(params_list[i])]:
+                    results[j] = result
+        return results
+
+    def put_many(self, params_list):
+        """ The results of ``put`` for each of ``params_list``, in order. """
+        return self._map(self.put, params_list)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            calls, retried, errors = self.calls, self.retried, self.errors
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        return {
+            'calls': calls,
+            'retries': retried,
+            'errors': errors,
+            'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'max': latencies[-1] if latencies else 0.0,
+        }
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+_client = None
+_client_lock = threading.Lock()
+
+def client():
+    """ The shared ``Client`` for ``SERVER``. """
+    global _client
+    with _client_lock:
+        if _client is None or _client.server != SERVER or (
+                (_client.cache and _client.cache.path) != CACHE_PATH):
+            cache = TagCache(CACHE_PATH) if CACHE_PATH else None
+            _client = Client(SERVER, cache=cache)
+        return _client
 
 def find_params(params):
     """
     Get all the tags for the vendor identified by the given args.
     """
-    url = SERVER + "tags/api"
-    data = urllib.urlencode({'params': json.dumps(params)})
-    headers = {'User-Agent': USER_AGENT}
-    request = urllib2.Request(url + "?" + data, None, headers)
-    response = urllib2.urlopen(request)
-    return response.read()
+    return client().find(params)
 
 def test_find_params():
     params = { 'tags': [{"key": "name", "value": "fedco"}] }
     print find_params(params)
 
 def put_params(params):
-    url = SERVER + "tags/api"
-    data = urllib.urlencode({'params': json.dumps(params)})
-    headers = {'User-Agent': USER_AGENT}
-    request = urllib2.Request(url, data, headers)
-    response = urllib2.urlopen(request)
-    return response.read()
+    return client().put(params)
 
 
 def test_put_params():
@@ -77,10 +450,12 @@ def import_transactions():
                 'vendor': result['vendor'],
                 'tags': [{"key": k, "value": v} for k,v in tags.iteritems()],
             }
-            result = put_params(kwargs)
-            print result
+            # Send each put as it is entered, so that an error or an
+            # interrupt loses at most the one being sent.
+            print client().put(kwargs)
 
 if __name__ == "__main__":
     #test_put_params()
     #test_find_params()
     #import_transactions()
+    pass
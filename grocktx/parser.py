@@ -19,11 +19,63 @@ in the following format:
             'phone': string, if present
         }
     }
+
+To parse many memos, e.g. a whole statement, use
+    parse_many(memos, dates=None)
+which takes any iterable of memos and lazily yields the same dicts in order.
+    parse_parallel(memos, dates=None, workers=None, chunksize=1000)
+does the same using a pool of worker processes.  All three take
+``compact=True`` to return slotted ``ParsedMemo`` objects, which take a
+fraction of the memory of the dicts; ``ParsedMemo.as_dict()`` converts back.
+    parse_columns(memos, dates=None, as_numpy=False)
+parses a batch of memos straight into columns, for analysis.
+
+Recently seen vendor descriptions are kept in ``vendor_cache``, a bounded LRU
+cache; ``memo_cache`` does the same for whole memos, but is off until given a
+size with ``resize(n)``.  See their ``stats()`` for hit rates, and
+``resize(0)`` to turn them off.
+
+The zip/city tables used to recognize vendor locations are loaded on first
+use; call ``preload()`` to load them up front.  ``ZIP`` still refers to them
+as it did when they were loaded at import, through ``zip_data()``.
+
+To see where parsing time goes, ``profile.enable()`` turns on per-stage
+counters (channel branches matched, regexes tried, cities scored, and calls
+to and seconds in each stage); ``profile.snapshot()`` returns them as a dict.
+They cost next to nothing while disabled.
+
+If this module is invoked from the command line, use the form:
+    $ python -m grocktx.parser [options] [file]
+to parse memos (and optional dates) from a CSV or JSONL file, or STDIN, and
+write the results to STDOUT as they are parsed.  See --help for the options.
 """
-import os
 import re
+import sys
 import csv
+import gzip
+import json
+import time
+import optparse
 import datetime
+import itertools
+import threading
+import array
+import collections
+import multiprocessing
+
+import zipdata
+from zipdata import CityIndex, ZipData, zip_data, preload
+
+class _LazyZip(object):
+    """
+    Stands in for the old module-level ``ZIP`` table, which was loaded at
+    import: attributes are looked up on ``zip_data()``, loading it on first
+    use.
+    """
+    def __getattr__(self, name):
+        return getattr(zip_data(), name)
+
+ZIP = _LazyZip()
 
 # Utilities
 CHAN_SEP = "(#\s+-\s+|\s+/\s+)"
@@ -60,50 +112,308 @@ def _bash_amount(amount):
     else:
         return float(amount)
 
-class ZipData(object):
-    ZIP_CITY_DATA = os.path.join(os.path.dirname(__file__), "data", "zips.csv")
+class LRUCache(object):
+    """
+    A bounded, thread-safe least-recently-used cache that counts hits,
+    misses and evictions.  A ``maxsize`` of 0 disables it.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            self._trim()
+
+    def _trim(self):
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        """ Change the bound, evicting the oldest entries if need be. """
+        with self.lock:
+            self.maxsize = maxsize
+            self._trim()
+
+    def clear(self):
+        """ Drop all entries and reset the counters. """
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+class StageProfile(object):
+    """
+    Opt-in counters of where the parser spends its time: which channel
+    branch of ``parse_memo`` matched each memo, how many channel regexes were
+    tried, how many cities ``parse_city`` scored, and the calls to and
+    cumulative seconds in each stage:
+        'parse_memo': the whole of parse_memo
+        'regex': matching the channel regexes
+        'date': parsing POS/ATM and credit card dates
+        'vendor': parse_vendor (including parse_city)
+        'city': parse_city
+    Disabled, it costs a flag check per stage.  Counts only cover parsing
+    done in this process, not in ``parse_parallel``'s workers, and cache
+    hits skip parse_memo (and parse_vendor) altogether.
+    """
+    STAGES = ('parse_memo', 'regex', 'date', 'vendor', 'city')
 
     def __init__(self):
-        self.cities_by_state = {}
-        self.cities_by_zip = {}
-        with open(self.ZIP_CITY_DATA) as file:
-            reader = csv.reader(file)
-            for zip, city, state in reader:
-                arr = self.cities_by_zip.get(zip, [])
-                arr.append(city)
-                self.cities_by_zip[zip] = arr
-
-                arr = self.cities_by_state.get(state, [])
-                arr.append(city)
-                self.cities_by_state[state] = arr
-ZIP = ZipData()
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.branches = {}
+            self.regexes_tried = 0
+            self.cities_scored = 0
+            self.calls = dict.fromkeys(self.STAGES, 0)
+            self.seconds = dict.fromkeys(self.STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.calls[stage] += 1
+            self.seconds[stage] += seconds
+
+    def memo(self, branch, tried, regex_seconds, seconds):
+        with self.lock:
+            self.branches[branch] = self.branches.get(branch, 0) + 1
+            self.regexes_tried += tried
+            self.calls['regex'] += tried
+            self.seconds['regex'] += regex_seconds
+            self.calls['parse_memo'] += 1
+            self.seconds['parse_memo'] += seconds
+
+    def city(self, scored, seconds):
+        with self.lock:
+            self.cities_scored += scored
+            self.calls['city'] += 1
+            self.seconds['city'] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'memos': self.calls['parse_memo'],
+                'branches': dict(self.branches),
+                'regexes_tried': self.regexes_tried,
+                'cities_scored': self.cities_scored,
+                'calls': dict(self.calls),
+                'seconds': dict(self.seconds),
+            }
+
+# Turn on with profile.enable(); read with profile.snapshot().
+profile = StageProfile()
+
+def _copy_parsed(parsed):
+    """ Copy a parsed memo deep enough that callers cannot alter the cache. """
+    copy = dict(parsed)
+    for key, value in copy.iteritems():
+        if isinstance(value, dict):
+            copy[key] = dict(value)
+    return copy
+
+_HALF_YEAR = datetime.timedelta(180)
+_NO_TIME = datetime.timedelta(0)
+
+class Vendor(object):
+    """
+    A compact, slotted form of the ``vendor`` dict of a parsed memo, for
+    holding millions of them in memory.  ``as_dict()`` gives the dict back.
+    """
+    __slots__ = ('description', 'city', 'state', 'zip', 'phone')
+
+    def __init__(self, description="", city="", state="", zip="", phone=""):
+        self.description = description
+        self.city = city
+        self.state = state
+        self.zip = zip
+        self.phone = phone
+
+    def as_dict(self):
+        return {
+            'description': self.description,
+            'city': self.city,
+            'state': self.state,
+            'zip': self.zip,
+            'phone': self.phone,
+        }
+
+    def __reduce__(self):
+        return (Vendor, (self.description, self.city, self.state, self.zip,
+                         self.phone))
+
+    def __eq__(self, other):
+        return isinstance(other, Vendor) and \
+                self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Vendor(%r, %r, %r, %r, %r)" % self.__reduce__()[1]
+
+class ParsedMemo(object):
+    """
+    A compact, slotted form of the dict returned by ``parse``, returned by
+    ``parse(..., compact=True)``.  ``channel_details`` is None when the dict
+    form has no 'channel_details', and ``vendor`` is a ``Vendor`` or None.
+    ``as_dict()`` gives the dict back.
+    """
+    __slots__ = ('channel', 'channel_details', 'vendor')
+
+    def __init__(self, channel, channel_details=None, vendor=None):
+        self.channel = channel
+        self.channel_details = channel_details
+        self.vendor = vendor
+
+    @classmethod
+    def from_dict(cls, parsed):
+        vendor = parsed['vendor']
+        if vendor is not None:
+            vendor = Vendor(vendor['description'], vendor['city'],
+                    vendor['state'], vendor['zip'], vendor['phone'])
+        return cls(parsed['channel'], parsed.get('channel_details', None),
+                vendor)
+
+    def as_dict(self):
+        parsed = {'channel': self.channel}
+        if self.channel_details is not None:
+            parsed['channel_details'] = dict(self.channel_details)
+        if self.vendor is not None:
+            parsed['vendor'] = self.vendor.as_dict()
+        else:
+            parsed['vendor'] = None
+        return parsed
+
+    def __reduce__(self):
+        return (ParsedMemo, (self.channel, self.channel_details, self.vendor))
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedMemo) and \
+                self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "ParsedMemo(%r, %r, %r)" % self.__reduce__()[1]
 
 def parse_pos_date(date_time_str, target):
     """
     Parse a POS/ATM date string, which lacks a 'year'.  Get the year from the
     date in ``target``, which should be a date near the correct date.  This is
     done to correct for the boundaries near Jan 1.
+
+    The string is fixed width ("MMDD HHMM"), so it is sliced directly rather
+    than run through strptime, which is slow and takes a global lock.
     """
-    date = datetime.datetime.strptime("%s %s" % (
-            target.year,
-            date_time_str),
-        "%Y %m%d %H%M")
+    if len(date_time_str) != 9 or date_time_str[4] != " " or \
+            not (date_time_str[:4] + date_time_str[5:]).isdigit():
+        raise ValueError("time data %r does not match format '%%m%%d %%H%%M'"
+                % date_time_str)
+    month = int(date_time_str[0:2])
+    day = int(date_time_str[2:4])
+    hour = int(date_time_str[5:7])
+    minute = int(date_time_str[7:9])
+    date = datetime.datetime(target.year, month, day, hour, minute)
     # Handle the case where we guess the wrong year because we're near Jan 1.
     diff = date - target
-    if abs(diff) > datetime.timedelta(180):
-        if diff < datetime.timedelta(0):
-            date = datetime.datedatetime(date.year + 1, date.month, date.day, 
-                    date.hour, date.minute)
+    if abs(diff) > _HALF_YEAR:
+        if diff < _NO_TIME:
+            date = datetime.datetime(date.year + 1, month, day, hour, minute)
         else:
-            date = datetime.datetime(date.year - 1, date.month, date.day,
-                    date.hour, date.minute)
+            date = datetime.datetime(date.year - 1, month, day, hour, minute)
     return date
 
+def parse_cc_date(date_str):
+    """
+    Parse a credit card "MM-DD-YY" date into "YYYY-MM-DD", with two digit
+    years read as strptime's %y does (69-99 are 1900s, 00-68 2000s).
+    """
+    if len(date_str) != 8 or date_str[2] != "-" or date_str[5] != "-" or \
+            not (date_str[:2] + date_str[3:5] + date_str[6:]).isdigit():
+        raise ValueError("time data %r does not match format '%%m-%%d-%%y'"
+                % date_str)
+    year = int(date_str[6:8])
+    year += 1900 if year >= 69 else 2000
+    date = datetime.date(year, int(date_str[0:2]), int(date_str[3:5]))
+    return "%04d-%02d-%02d" % (date.year, date.month, date.day)
+
+def _format_date(date):
+    if date.year < 1900:
+        # Keep strftime's ValueError for dates it can't format.
+        return date.strftime("%Y-%m-%d")
+    return "%04d-%02d-%02d" % (date.year, date.month, date.day)
+
+# Results of parse_vendor for recently seen descriptions.  POS and ATM memos
+# for the same vendor differ in their dates and auth numbers, but share the
+# trailing vendor description, so this catches repeats that memo_cache
+# can't.  Resize with vendor_cache.resize(n); 0 disables it.
+vendor_cache = LRUCache(10000)
+
 def parse_vendor(description):
+    """
+    Split a vendor description into description, city, state, zip and
+    phone.  Returns None for an empty description.
+    """
     memo = description.strip()
     if not memo:
         return None
+    if not vendor_cache.maxsize:
+        return _timed_parse_vendor(memo)
+    vendor = vendor_cache.get(memo)
+    if vendor is not None:
+        return dict(vendor)
+    vendor = _timed_parse_vendor(memo)
+    vendor_cache.put(memo, dict(vendor))
+    return vendor
+
+def _timed_parse_vendor(memo):
+    if not profile.enabled:
+        return _parse_vendor(memo)
+    start = time.time()
+    try:
+        return _parse_vendor(memo)
+    finally:
+        profile.add('vendor', time.time() - start)
 
+def _parse_vendor(memo):
     vendor = {
         'description': "",
         'state': "",
@@ -112,7 +422,8 @@ def parse_vendor(description):
         'phone': "",
     }
     memo_guess, state_guess = memo[:-2].strip(), memo[-2:]
-    cities = ZIP.cities_by_state.get(state_guess, None)
+    zips = zip_data()
+    cities = zips.city_index(state_guess)
     if cities:
         # We have a state match.
         vendor['state'] = state_guess
@@ -131,7 +442,7 @@ def parse_vendor(description):
         if match:
             vendor['description'] = match.group('description')
             vendor['zip'] = match.group('zip')
-            vendor['city'] = ZIP.cities_by_zip.get(vendor['zip'], [""])[0]
+            vendor['city'] = zips.zip_city(vendor['zip'])
             return vendor
 
         # Otherwise, try to match city.
@@ -143,6 +454,25 @@ def parse_vendor(description):
     vendor['description'] = memo
     return vendor
 
+def _score_city(city, pot_city):
+    """
+    Score ``pot_city`` as an abbreviation of ``city``: walk both from the end,
+    +1 for each matching character, -1 for each character of ``city`` that
+    had to be skipped.
+    """
+    pot_city_pos = len(pot_city) - 1
+    score = 0
+    for i in range(len(city) - 1, -1, -1):
+        if pot_city_pos < 0:
+            score -= i
+            break
+        if city[i] == pot_city[pot_city_pos]:
+            score += 1
+            pot_city_pos -= 1
+        else:
+            score -=1
+    return score
+
 def parse_city(cities, memo):
     """ 
     Split off a (potentially abbreviated) city stub from the end of the
@@ -153,142 +483,146 @@ def parse_city(cities, memo):
        than the real city name.
     3. The city abbreviation will be preceded by a space or the beginning
        of the string.
+
+    ``cities`` is a ``CityIndex`` or a plain sequence of city names.  Ties
+    go to the city that comes first in ``cities``.
     """
+    start = profile.enabled and time.time()
+    if not isinstance(cities, CityIndex):
+        cities = CityIndex(cities)
     words = memo.split(' ')
+
+    # The candidate stub for a city of a given length is the longest run of
+    # trailing words that fits in that length; it is the same for every city
+    # of that length.  A stub of length n can score at most 2n - length + 1
+    # against a longer city, or length against a city of its own length.
+    candidates = []
+    num_words = 0
+    run_length = -1 # initial space
+    for length in cities.lengths:
+        while num_words < len(words) and \
+                run_length + len(words[-num_words - 1]) + 1 <= length:
+            run_length += len(words[-num_words - 1]) + 1
+            num_words += 1
+        if not num_words:
+            continue
+        if run_length < length:
+            bound = 2 * run_length - length + 1
+        else:
+            bound = length
+        group = cities.groups[length]
+        candidates.append((-bound, group[0][0], num_words, group))
+    candidates.sort()
+
     best_score = 0
+    best_rank = None
     best_city = None
     remainder = None
-    for city in cities:
-        pot_words = []
-        run_length = -1 # initial space
-        for word in reversed(words):
-            if run_length + len(word) + 1 <= len(city):
-                pot_words.insert(0, word)
-                run_length += len(word) + 1 # add one for space
-            else:
-                break
-        pot_city = (" ".join(pot_words)).upper()
-        pot_city_pos = len(pot_city) - 1
-        score = 0
-        for i in range(len(city) - 1, -1, -1):
-            if pot_city_pos < 0:
-                score -= i
+    scored = 0
+    for neg_bound, first_rank, num_words, group in candidates:
+        bound = -neg_bound
+        if bound < best_score or \
+                (bound == best_score and first_rank > best_rank):
+            break
+        pot_city = (" ".join(words[-num_words:])).upper()
+        for rank, city in group:
+            if bound == best_score and rank > best_rank:
                 break
-            if city[i] == pot_city[pot_city_pos]:
-                score += 1
-                pot_city_pos -= 1
-            else:
-                score -=1
-        if score > best_score:
-            best_score = score
-            best_city = city
-            remainder = " ".join(words[:-len(pot_words)])
+            score = _score_city(city, pot_city)
+            scored += 1
+            if score > best_score or \
+                    (score == best_score and score > 0 and rank < best_rank):
+                best_score = score
+                best_rank = rank
+                best_city = city
+                remainder = " ".join(words[:-num_words])
 
+    if start:
+        profile.city(scored, time.time() - start)
     if best_city and best_score > len(best_city) / 2:
         return remainder, best_city
     else:
         return memo, ""
 
-def parse_memo(memo, approx_date):
-    parsed = {'vendor': {
-        'description': "",
-        'city': "",
-        'state': "",
-        'zip': "",
-        'phone': "",
-        }}
-    if not memo:
-        parsed['channel'] = "unknown"
-        return parsed
+# Channel handlers.  Each is given the match of its regex and fills in
+# ``parsed``, returning it, or returns None to let the next channel try.
 
-    # checks
-    match = check_re.match(memo)
-    if match:
-        parsed['channel'] = "check"
-        checkno = match.group('checkno') or ""
-        parsed['channel_details'] = {
-            'check_number': checkno
-        }
-        parsed['vendor']["description"] = "CHECK %s" % checkno
-        return parsed
+def _parse_check(parsed, match, approx_date):
+    parsed['channel'] = "check"
+    checkno = match.group('checkno') or ""
+    parsed['channel_details'] = {
+        'check_number': checkno
+    }
+    parsed['vendor']["description"] = "CHECK %s" % checkno
+    return parsed
 
-    # POS and ATM transactions
-    for channel, regex in (
-            ('pos', pos_re),
-            ('atm', atm_re)):
-        match = regex.match(memo)
-        if match:
-            parsed['channel'] = channel
-            try:
-                date = parse_pos_date(match.group('date'), approx_date)
-                parsed['channel_details'] = {
-                    'auth_date': date.strftime("%Y-%m-%d"),
-                    'auth_time': date.strftime("%H:%M"),
-                    'auth': str(match.group('auth'))
-                }
-                parsed['vendor'] = parse_vendor(match.group('description'))
-                return parsed
-            except ValueError:
-                pass
-
-    # credit card transactions
-    match = credit_card_re.match(memo)
-    if match:
-        parsed['channel'] = "pos"
+def _parse_pos_atm(channel):
+    def handler(parsed, match, approx_date):
+        parsed['channel'] = channel
         try:
+            start = profile.enabled and time.time()
+            date = parse_pos_date(match.group('date'), approx_date)
+            if start:
+                profile.add('date', time.time() - start)
             parsed['channel_details'] = {
-                'auth_date': datetime.datetime.strptime(
-                    match.group('date'), "%m-%d-%y").strftime("%Y-%m-%d"),
-                'auth': str(match.group('auth')),
+                'auth_date': _format_date(date),
+                'auth_time': "%02d:%02d" % (date.hour, date.minute),
+                'auth': str(match.group('auth'))
             }
             parsed['vendor'] = parse_vendor(match.group('description'))
             return parsed
         except ValueError:
             pass
+    return handler
 
-    # transfers
-    match = transfer_re.match(memo)
-    if match:
-        parsed['channel'] = "transfer"
-        if match.group('acct_descr'):
-            parsed['channel_details'] = {
-                'account_description': match.group('acct_descr')
-            }
-        parsed['vendor']['description'] = memo
+def _parse_credit_card(parsed, match, approx_date):
+    parsed['channel'] = "pos"
+    try:
+        start = profile.enabled and time.time()
+        auth_date = parse_cc_date(match.group('date'))
+        if start:
+            profile.add('date', time.time() - start)
+        parsed['channel_details'] = {
+            'auth_date': auth_date,
+            'auth': str(match.group('auth')),
+        }
+        parsed['vendor'] = parse_vendor(match.group('description'))
         return parsed
+    except ValueError:
+        pass
 
-    # deposits
-    match = deposit_re.match(memo)
-    if match:
-        parsed['channel'] = "deposit"
-        parsed['vendor']['description'] = match.group('description') or \
-                "deposit"
-        return parsed
+def _parse_transfer(parsed, match, approx_date):
+    parsed['channel'] = "transfer"
+    if match.group('acct_descr'):
+        parsed['channel_details'] = {
+            'account_description': match.group('acct_descr')
+        }
+    parsed['vendor']['description'] = match.string
+    return parsed
 
-    # dividends
-    match = dividend_re.match(memo)
-    if match:
-        parsed['channel'] = "dividend"
-        parsed['vendor']['description'] = match.group('description') or \
-                "dividend"
-        return parsed
+def _parse_deposit(parsed, match, approx_date):
+    parsed['channel'] = "deposit"
+    parsed['vendor']['description'] = match.group('description') or \
+            "deposit"
+    return parsed
 
-    # fees and rev fees
-    for regex in (rev_fee_re, fee_re):
-        match = regex.match(memo)
-        if match:
-            parsed['channel'] = match.group("type").lower()
-            if match.group("amount"):
-                parsed['channel_details'] = {
-                    'amount': _bash_amount(match.group("amount"))
-                }
-            parsed['vendor']['description'] = match.group("description")
-            return parsed
-            
+def _parse_dividend(parsed, match, approx_date):
+    parsed['channel'] = "dividend"
+    parsed['vendor']['description'] = match.group('description') or \
+            "dividend"
+    return parsed
+
+def _parse_fee(parsed, match, approx_date):
+    parsed['channel'] = match.group("type").lower()
+    if match.group("amount"):
+        parsed['channel_details'] = {
+            'amount': _bash_amount(match.group("amount"))
+        }
+    parsed['vendor']['description'] = match.group("description")
+    return parsed
 
-    # everything else
-    match = other_re.match(memo)
-    if match and match.group('type'):
+def _parse_other(parsed, match, approx_date):
+    if match.group('type'):
         type = match.group('type').lower()
         if type in ["fee"]:
             parsed['channel'] = type
@@ -302,13 +636,436 @@ def parse_memo(memo, approx_date):
                 parsed['vendor']['description'] = match.group('description')
             return parsed
 
+# The channels in the order they are tried, as (branch, initials, needle,
+# regex, handler).  A memo can only match a channel's regex if it starts
+# with one of ``initials`` (None: any) and contains ``needle`` (None:
+# anything), so parse_memo only tries the regexes that can apply instead of
+# running every one of them on every memo.  ``branch`` names the channel
+# for ``profile``.
+CHANNELS = (
+    ("check", "S", None, check_re, _parse_check),
+    ("pos", None, "POS ", pos_re, _parse_pos_atm('pos')),
+    ("atm", None, "ATM ", atm_re, _parse_pos_atm('atm')),
+    ("credit card", None, " auth# ", credit_card_re, _parse_credit_card),
+    ("transfer", "T", None, transfer_re, _parse_transfer),
+    ("deposit", "D", None, deposit_re, _parse_deposit),
+    ("dividend", "DS", None, dividend_re, _parse_dividend),
+    ("rev fee", "R", None, rev_fee_re, _parse_fee),
+    ("fee", "F", None, fee_re, _parse_fee),
+    ("other", None, None, other_re, _parse_other),
+)
+
+def _channels_by_initial():
+    initials = set()
+    for branch, channel_initials, needle, regex, handler in CHANNELS:
+        initials.update(channel_initials or "")
+    by_initial = {}
+    for initial in list(initials) + [None]:
+        by_initial[initial] = tuple((branch, needle, regex, handler)
+            for branch, channel_initials, needle, regex, handler in CHANNELS
+            if channel_initials is None or
+               (initial is not None and initial in channel_initials))
+    return by_initial
+_CHANNELS_BY_INITIAL = _channels_by_initial()
+
+def parse_memo(memo, approx_date):
+    if profile.enabled:
+        return _profiled_parse_memo(memo, approx_date)
+    parsed = {'vendor': {
+        'description': "",
+        'city': "",
+        'state': "",
+        'zip': "",
+        'phone': "",
+        }}
+    if not memo:
+        parsed['channel'] = "unknown"
+        return parsed
+
+    channels = _CHANNELS_BY_INITIAL.get(memo[0], None)
+    if channels is None:
+        channels = _CHANNELS_BY_INITIAL[None]
+    for branch, needle, regex, handler in channels:
+        if needle is not None and needle not in memo:
+            continue
+        match = regex.match(memo)
+        if match and handler(parsed, match, approx_date) is not None:
+            return parsed
+
     # fallback
     parsed['channel'] = "unknown"
     parsed['vendor']['description'] = memo
     return parsed
 
-def parse(memo, date=None):
-    """ Parse a memo string. """
+def _profiled_parse_memo(memo, approx_date):
+    """ ``parse_memo``, counting and timing its steps in ``profile``. """
+    start = time.time()
+    parsed = {'vendor': {
+        'description': "",
+        'city': "",
+        'state': "",
+        'zip': "",
+        'phone': "",
+        }}
+    matched = "unknown"
+    tried = 0
+    regex_seconds = 0.0
+    if memo:
+        channels = _CHANNELS_BY_INITIAL.get(memo[0], None)
+        if channels is None:
+            channels = _CHANNELS_BY_INITIAL[None]
+        for branch, needle, regex, handler in channels:
+            if needle is not None and needle not in memo:
+                continue
+            tried += 1
+            regex_start = time.time()
+            match = regex.match(memo)
+            regex_seconds += time.time() - regex_start
+            if match and handler(parsed, match, approx_date) is not None:
+                matched = branch
+                break
+        else:
+            parsed['channel'] = "unknown"
+            parsed['vendor']['description'] = memo
+    else:
+        parsed['channel'] = "unknown"
+    profile.memo(matched, tried, regex_seconds, time.time() - start)
+    return parsed
+
+# Results of parse_memo for recently seen memos, off by default; turn it on
+# with memo_cache.resize(n) for inputs with many repeats.  POS and ATM memos
+# carry no year, so their results depend on the reference date; they are not
+# cached here, but their vendor lookups are (see vendor_cache).
+memo_cache = LRUCache(0)
+
+def _parse(memo, date):
+    if not memo_cache.maxsize or "POS " in memo or "ATM " in memo:
+        return parse_memo(memo, date)
+    parsed = memo_cache.get(memo)
+    if parsed is not None:
+        return _copy_parsed(parsed)
+    parsed = parse_memo(memo, date)
+    memo_cache.put(memo, _copy_parsed(parsed))
+    return parsed
+
+def parse(memo, date=None, compact=False):
+    """
+    Parse a memo string.  With ``compact=True``, return a ``ParsedMemo``
+    instead of a dict.
+    """
     if not date:
         date = datetime.datetime.now()
-    return parse_memo(memo.strip(), date)
+    if compact:
+        return ParsedMemo.from_dict(_parse(memo.strip(), date))
+    return _parse(memo.strip(), date)
+
+_MISSING = object()
+
+def _dated(memos, dates):
+    """
+    Pair each of ``memos`` with its date from ``dates`` (as for
+    ``parse_many``), defaulting to now.  Raises ValueError if ``dates`` is
+    an iterable of a different length.
+    """
+    now = datetime.datetime.now()
+    if dates is None or isinstance(dates, datetime.date):
+        for memo in memos:
+            yield memo, dates or now
+        return
+    for memo, date in itertools.izip_longest(memos, dates,
+                                             fillvalue=_MISSING):
+        if memo is _MISSING or date is _MISSING:
+            raise ValueError("memos and dates differ in length")
+        yield memo, date or now
+
+def parse_many(memos, dates=None, compact=False):
+    """
+    Parse an iterable of memo strings (which may be a generator), yielding
+    the results lazily in order.  ``dates`` is either an iterable of dates
+    matching ``memos`` or a single date used for all of them (ValueError is
+    raised if their lengths differ); missing dates default to the time
+    ``parse_many`` was called.  With ``compact=True``,
+    yield ``ParsedMemo`` objects instead of dicts.
+    """
+    for memo, date in _dated(memos, dates):
+        if compact:
+            yield ParsedMemo.from_dict(_parse(memo.strip(), date))
+        else:
+            yield _parse(memo.strip(), date)
+
+def _parse_chunk(chunk, compact):
+    if compact:
+        return [ParsedMemo.from_dict(_parse(memo.strip(), date))
+                for memo, date in chunk]
+    return [_parse(memo.strip(), date) for memo, date in chunk]
+
+def parse_parallel(memos, dates=None, workers=None, chunksize=1000,
+        stats=None, compact=False):
+    """
+    Like ``parse_many``, but parse chunks of ``chunksize`` memos in a pool of
+    ``workers`` processes (default: one per CPU).  Each worker loads the zip
+    tables once, using the same backend as this process if it has loaded
+    them.  Results are yielded in input order, and only a few chunks per
+    worker are read ahead of the consumer, so ``memos`` can be arbitrarily
+    long.  ``compact`` is as for ``parse_many``.
+
+    If ``stats`` is a dict, it is kept up to date with the number of memos
+    parsed, the elapsed seconds and the throughput in memos per second.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    pairs = _dated(memos, dates)
+    chunks = iter(lambda: list(itertools.islice(pairs, chunksize)), [])
+
+    loaded = zipdata._zip_data
+    backend = type(loaded) if loaded is not None else ZipData
+    pool = multiprocessing.Pool(workers, preload, (backend,))
+    pending = collections.deque()
+    start = time.time()
+    count = 0
+    try:
+        for chunk in itertools.islice(chunks, workers * 2):
+            pending.append(pool.apply_async(_parse_chunk, (chunk, compact)))
+        while pending:
+            results = pending.popleft().get()
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(pool.apply_async(_parse_chunk,
+                        (chunk, compact)))
+            count += len(results)
+            if stats is not None:
+                elapsed = time.time() - start
+                stats.update({
+                    'memos': count,
+                    'seconds': elapsed,
+                    'memos_per_second': count / elapsed if elapsed else 0.0,
+                    'workers': workers,
+                })
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Channels in the order of their codes in parse_columns' 'channel' column.
+CHANNEL_CODES = ("unknown", "check", "pos", "atm", "transfer", "deposit",
+                 "dividend", "fee", "rev fee", "withdraw")
+
+def parse_columns(memos, dates=None, as_numpy=False):
+    """
+    Parse a batch of memos into columns rather than one dict per memo.
+    ``memos`` and ``dates`` are as for ``parse_many``.  Returns a dict of
+    equal-length columns:
+        'channel': array of small ints, indexes into ``CHANNEL_CODES``
+        'description', 'city', 'phone': lists of strings, interned so that
+            repeated values share one string
+        'state', 'zip': fixed width (2 and 5 characters) char arrays, padded
+            with spaces; row i of 'zip' is ``zip[5 * i:5 * i + 5]``
+        'auth', 'check_number', 'account_description': lists of strings
+        'auth_date': array of date ordinals (0 if absent)
+        'auth_time': array of minutes after midnight (-1 if absent)
+        'amount': array of floats (nan if absent)
+    Strings absent from a memo are "".
+
+    With ``as_numpy=True``, return a NumPy structured array with one field per
+    column instead ('state' and 'zip' as fixed width byte strings, without
+    the padding).  This requires NumPy.
+    """
+    if as_numpy:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("parse_columns(as_numpy=True) requires numpy")
+    codes = dict((channel, i) for i, channel in enumerate(CHANNEL_CODES))
+    strings = {}
+    intern_ = lambda value: strings.setdefault(value, value)
+    columns = {
+        'channel': array.array('B'),
+        'description': [],
+        'city': [],
+        'state': array.array('c'),
+        'zip': array.array('c'),
+        'phone': [],
+        'auth': [],
+        'auth_date': array.array('i'),
+        'auth_time': array.array('h'),
+        'check_number': [],
+        'account_description': [],
+        'amount': array.array('d'),
+    }
+    nan = float('nan')
+    for parsed in parse_many(memos, dates):
+        columns['channel'].append(codes[parsed['channel']])
+        vendor = parsed['vendor'] or {}
+        columns['description'].append(intern_(vendor.get('description', "")))
+        columns['city'].append(intern_(vendor.get('city', "")))
+        columns['state'].fromstring(vendor.get('state', "").ljust(2)[:2])
+        columns['zip'].fromstring(vendor.get('zip', "").ljust(5)[:5])
+        columns['phone'].append(intern_(vendor.get('phone', "")))
+
+        details = parsed.get('channel_details', {})
+        columns['auth'].append(details.get('auth', ""))
+        auth_date = details.get('auth_date', None)
+        if auth_date:
+            columns['auth_date'].append(datetime.date(int(auth_date[0:4]),
+                int(auth_date[5:7]), int(auth_date[8:10])).toordinal())
+        else:
+            columns['auth_date'].append(0)
+        auth_time = details.get('auth_time', None)
+        if auth_time:
+            columns['auth_time'].append(
+                    int(auth_time[0:2]) * 60 + int(auth_time[3:5]))
+        else:
+            columns['auth_time'].append(-1)
+        columns['check_number'].append(details.get('check_number', ""))
+        columns['account_description'].append(
+                intern_(details.get('account_description', "")))
+        columns['amount'].append(details.get('amount', nan))
+
+    if not as_numpy:
+        return columns
+    rows = len(columns['channel'])
+    result = numpy.zeros(rows, dtype=[
+        ('channel', 'u1'),
+        ('description', 'O'),
+        ('city', 'O'),
+        ('state', 'S2'),
+        ('zip', 'S5'),
+        ('phone', 'O'),
+        ('auth', 'O'),
+        ('auth_date', 'i4'),
+        ('auth_time', 'i2'),
+        ('check_number', 'O'),
+        ('account_description', 'O'),
+        ('amount', 'f8'),
+    ])
+    for name in ('channel', 'auth_date', 'auth_time', 'amount'):
+        result[name] = numpy.frombuffer(columns[name],
+                columns[name].typecode)
+    for name, width in (('state', 2), ('zip', 5)):
+        result[name] = numpy.char.rstrip(
+                numpy.frombuffer(columns[name].tostring(), 'S%d' % width))
+    for name in ('description', 'city', 'phone', 'auth', 'check_number',
+            'account_description'):
+        result[name] = columns[name]
+    return result
+
+# Command line interface.
+
+CSV_FIELDS = ("memo", "channel", "description", "city", "state", "zip",
+              "phone", "auth", "auth_date", "auth_time", "check_number",
+              "account_description", "amount")
+
+def _parse_date(value):
+    """ Parse a "YYYY-MM-DD" date (ignoring any time after it), or None. """
+    if not value:
+        return None
+    return datetime.datetime.strptime(value[:10], "%Y-%m-%d")
+
+def _read_csv(file, header):
+    """ Yield (memo, date) from rows of memo[,date]. """
+    reader = csv.reader(file)
+    if header:
+        next(reader, None)
+    for row in reader:
+        if not row:
+            continue
+        yield row[0], _parse_date(row[1] if len(row) > 1 else None)
+
+def _read_jsonl(file):
+    """
+    Yield (memo, date) from lines holding either a JSON string (the memo) or
+    an object with "memo" and optionally "date" keys.
+    """
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if isinstance(record, dict):
+            memo, date = record['memo'], _parse_date(record.get('date'))
+        else:
+            memo, date = record, None
+        if isinstance(memo, unicode):
+            memo = memo.encode('utf-8')
+        yield memo, date
+
+def _csv_row(memo, parsed):
+    vendor = parsed['vendor'] or {}
+    details = parsed.get('channel_details', {})
+    row = [memo, parsed['channel']]
+    row.extend(vendor.get(key, "") for key in CSV_FIELDS[2:7])
+    row.extend(details.get(key, "") for key in CSV_FIELDS[7:])
+    return [value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row]
+
+def main(argv=None):
+    usage = "usage: %prog [options] [file]"
+    opts = optparse.OptionParser(usage=usage, description="Parse transaction "
+            "memos from a CSV (memo[,date]) or JSONL (\"memo\" or {\"memo\": "
+            "..., \"date\": ...}) file, or STDIN, writing one result per memo "
+            "as it goes.  Dates are YYYY-MM-DD.  Files ending in .gz are "
+            "decompressed.")
+    opts.add_option("-i", "--input-format", choices=("csv", "jsonl"),
+            help="csv or jsonl (default: from the file name, else jsonl)")
+    opts.add_option("-o", "--output-format", choices=("jsonl", "csv"),
+            default="jsonl", help="jsonl (default) or csv")
+    opts.add_option("--header", action="store_true",
+            help="skip the first row of CSV input")
+    opts.add_option("-w", "--workers", type="int", default=1,
+            help="parse in this many processes (default: 1)")
+    opts.add_option("--chunksize", type="int", default=1000,
+            help="memos sent to a worker at a time (default: 1000)")
+    options, args = opts.parse_args(argv)
+    if len(args) > 1:
+        opts.error("expected at most one input file")
+
+    path = args[0] if args and args[0] != "-" else None
+    input_format = options.input_format
+    if not input_format:
+        name = (path or "").lower()
+        if name.endswith(".gz"):
+            name = name[:-3]
+        input_format = "csv" if name.endswith(".csv") else "jsonl"
+    if path is None:
+        file = sys.stdin
+    elif path.endswith(".gz"):
+        file = gzip.open(path, 'rb')
+    else:
+        file = open(path, 'rb')
+
+    if input_format == "csv":
+        records = _read_csv(file, options.header)
+    else:
+        records = _read_jsonl(file)
+    # Each record is needed three times: for its memo, its date and to echo
+    # the memo in the output.  The copies are consumed in step, so tee only
+    # holds the few records the parser reads ahead.
+    memos, dates, echoes = itertools.tee(records, 3)
+    memos = (memo for memo, date in memos)
+    dates = (date for memo, date in dates)
+    echoes = (memo for memo, date in echoes)
+    if options.workers > 1:
+        results = parse_parallel(memos, dates, workers=options.workers,
+                chunksize=options.chunksize)
+    else:
+        results = parse_many(memos, dates)
+
+    out = sys.stdout
+    if options.output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(CSV_FIELDS)
+    try:
+        for memo, parsed in itertools.izip(echoes, results):
+            if options.output_format == "csv":
+                writer.writerow(_csv_row(memo, parsed))
+            else:
+                parsed = dict(parsed, memo=memo)
+                out.write(json.dumps(parsed))
+                out.write("\n")
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+A pipelined enrichment run: scrape accounts' transactions, parse their memos
+and look up their vendors' tags on the GrockTX tagging server, with the three
+stages running at once on threads joined by bounded queues.
+
+    enrich(jobs, fetch_workers=4, parse_workers=1, tag_concurrency=4,
+           client=None, queue_size=1000, chunksize=100, stats=None,
+           providers=None)
+
+``jobs`` is a list of (provider, username, password) tuples, and
+``providers`` maps provider names to scraper classes, as for
+``scraper.iter_accounts``.  Transactions are yielded as they come out of the
+last stage, in no particular order, each with a 'tags' key holding the
+decoded lookup result (or None, for channels without a vendor to look up or
+when the lookup failed).
+
+  * ``fetch_workers`` threads download the accounts, each reusing one
+    connection (see ``scraper.CurlSession``), and pass on each transaction as
+    it is read, unparsed.
+  * One thread parses the memos, with ``parser.parse_many``; with
+    ``parse_workers`` > 1, it farms chunks of ``chunksize`` memos out to a
+    pool of processes with ``parser.parse_parallel``.
+  * ``tag_concurrency`` threads look the vendors up through ``client`` (by
+    default ``grocktx_server_client.client()``, whose cache applies); a
+    client with at least that many ``connections`` keeps them all open.
+
+Each queue holds at most ``queue_size`` transactions, so a slow stage holds
+up the ones before it rather than letting transactions pile up in memory,
+and the whole run takes about as long as its slowest stage.  If the caller
+stops early (closing the generator) or the parse stage fails, the other
+stages are told to stop, and their threads exit and close their
+connections.
+
+If ``stats`` is a dict, it is kept up to date with the number of
+transactions 'fetched', 'parsed' and 'tagged', the 'errors' (a list of
+messages: accounts that could not be fetched and lookups that failed), and
+the elapsed 'seconds'.
+"""
+import json
+import time
+import itertools
+import threading
+import Queue
+
+import parser
+import scraper
+import grocktx_server_client
+
+# Channels whose vendors are worth looking up.
+TAGGED_CHANNELS = ('atm', 'pos', 'deposit', 'dividend', 'fee', 'rev fee')
+
+# Marks the end of a queue.
+_DONE = object()
+
+# How often, in seconds, threads waiting on a queue check for a stop.
+_POLL = 0.1
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args,
+                              name="enrich-" + target.__name__)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def enrich(jobs, fetch_workers=4, parse_workers=1, tag_concurrency=4,
+           client=None, queue_size=1000, chunksize=100, stats=None,
+           providers=None):
+    client = client or grocktx_server_client.client()
+    providers = providers or scraper.PROVIDERS
+    if stats is None:
+        stats = {}
+    stats.update({'fetched': 0, 'parsed': 0, 'tagged': 0, 'errors': [],
+                  'seconds': 0.0})
+    lock = threading.Lock()
+    failures = []
+    pending = Queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    fetched = Queue.Queue(queue_size)
+    parsed = Queue.Queue(queue_size)
+    tagged = Queue.Queue(queue_size)
+    fetchers = [min(fetch_workers, pending.qsize())]
+    stop = threading.Event()
+    start = time.time()
+
+    def put(queue, item):
+        """ Put ``item`` on ``queue``; False if the run was stopped first. """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(queue):
+        """ The next item on ``queue``, or _DONE if the run is stopped. """
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=_POLL)
+            except Queue.Empty:
+                pass
+        return _DONE
+
+    def count(key, error=None):
+        with lock:
+            stats[key] += 1
+            if error is not None:
+                stats['errors'].append(error)
+            stats['seconds'] = time.time() - start
+
+    def fetch():
+        session = scraper.CurlSession()
+        try:
+            while not stop.is_set():
+                try:
+                    provider, username, password = pending.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    if provider not in providers:
+                        raise ValueError("Provider %s not supported" %
+                                         provider)
+                    source = providers[provider](session, parse_memos=False)
+                    txs = source.iter_transactions(username, password)
+                    try:
+                        for tx in txs:
+                            if not put(fetched, (source, tx)):
+                                break
+                            count('fetched')
+                    finally:
+                        txs.close()
+                except Exception, e:
+                    with lock:
+                        stats['errors'].append("%s %s: %s: %s" % (provider,
+                                username, e.__class__.__name__, e))
+        finally:
+            session.close()
+            with lock:
+                fetchers[0] -= 1
+                last = not fetchers[0]
+            if last:
+                put(fetched, _DONE)
+
+    def parse():
+        results = None
+        try:
+            def rows():
+                while True:
+                    row = get(fetched)
+                    if row is _DONE:
+                        return
+                    yield row
+            rows, memos, dates = itertools.tee(rows(), 3)
+            memos = (source.memo(tx) for source, tx in memos)
+            dates = (scraper._iso_date(tx['date']) for source, tx in dates)
+            if parse_workers > 1:
+                results = parser.parse_parallel(memos, dates, parse_workers,
+                                                chunksize)
+            else:
+                results = parser.parse_many(memos, dates)
+            for (source, tx), result in itertools.izip(rows, results):
+                tx.update(result)
+                if not put(parsed, tx):
+                    break
+                count('parsed')
+        except Exception, e:
+            failures.append(e)
+            stop.set()
+        finally:
+            if results is not None:
+                # Shuts down parse_parallel's pool if we stopped early.
+                results.close()
+            put(parsed, _DONE)
+
+    def tag():
+        while True:
+            tx = get(parsed)
+            if tx is _DONE:
+                # Pass the end on to the other taggers.
+                put(parsed, _DONE)
+                put(tagged, _DONE)
+                return
+            tx['tags'] = None
+            error = None
+            if tx.get('channel') in TAGGED_CHANNELS:
+                try:
+                    tx['tags'] = json.loads(client.find(
+                            {'vendor': tx['vendor']}))
+                except Exception, e:
+                    error = "%s %s: %s: %s" % (tx['data_source'],
+                            tx['unique_id'], e.__class__.__name__, e)
+            if not put(tagged, tx):
+                return
+            count('tagged', error)
+
+    if fetchers[0]:
+        for i in xrange(fetchers[0]):
+            _start(fetch)
+    else:
+        fetched.put(_DONE)
+    _start(parse)
+    for i in xrange(tag_concurrency):
+        _start(tag)
+
+    try:
+        finished = 0
+        while finished < tag_concurrency:
+            tx = get(tagged)
+            if tx is _DONE:
+                if stop.is_set():
+                    break
+                finished += 1
+            else:
+                yield tx
+    finally:
+        # Let the other stages go if we are done or the caller stopped early.
+        stop.set()
+    stats['seconds'] = time.time() - start
+    if failures:
+        raise failures[0]
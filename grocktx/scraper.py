@@ -10,9 +10,29 @@ The module defines one public method:
 
 The method returns a list of dicts which contain parsed details of bank
 transactions available from the given provider (e.g. mint or wesabe).
+    iter_transactions(provider, username, password)
+yields the same dicts one at a time, as the provider's export is downloaded.
+
+Saved exports (e.g. archived downloads, optionally gzip-compressed) are
+parsed without logging in by
+    iter_file(provider, path)
+or MintScraper.parse_file and WesabeScraper.parse_file.
+
+To scrape many accounts at once,
+    iter_accounts(jobs, workers=4)
+runs a list of (provider, username, password) jobs on a pool of threads, each
+reusing its connections, and yields each account's transactions, timing and
+error (if any) as it finishes.
+
+For daily syncs,
+    iter_sync(SyncState(path), provider, username, password)
+yields only the transactions not seen on earlier syncs, keeping per-account
+state in a SQLite file at ``path`` (also --sync-state on the command line).
 
 If this module is invoked from the command line, use the form:
     $ scraper.py <provider> <username> <password>
+or, for a saved export:
+    $ scraper.py --from-file <path> <provider>
 JSON containing the transactions will be returned to STDOUT.
 
 The transaction dicts or JSON returned have the following form:
@@ -73,12 +93,17 @@ The transaction dicts or JSON returned have the following form:
 import re
 import sys
 import csv
+import gzip
 import json
 import base64
 import hashlib
-import StringIO
-import urllib2, urllib
+import time
+import urllib
+import sqlite3
 import datetime
+import optparse
+import threading
+import Queue
 from htmlentitydefs import name2codepoint
 
 import pycurl
@@ -86,6 +111,23 @@ from BeautifulSoup import BeautifulSoup
 
 import parser
 
+def _mint_date(date_str):
+    """
+    ``datetime.datetime.strptime(date_str, "%m/%d/%Y")``, without the cost of
+    strptime for the usual zero-padded dates.
+    """
+    if len(date_str) == 10 and date_str[2] == date_str[5] == "/":
+        return datetime.datetime(int(date_str[6:]), int(date_str[:2]),
+                                 int(date_str[3:5]))
+    return datetime.datetime.strptime(date_str, "%m/%d/%Y")
+
+def _iso_date(date_str):
+    """ As ``_mint_date``, for "%Y-%m-%d" dates. """
+    if len(date_str) == 10 and date_str[4] == date_str[7] == "-":
+        return datetime.datetime(int(date_str[:4]), int(date_str[5:7]),
+                                 int(date_str[8:]))
+    return datetime.datetime.strptime(date_str, "%Y-%m-%d")
+
 class MintScraper(object):
     base_url = "https://www.mint.com"
     login_url = "https://wwws.mint.com/login.event"
@@ -94,23 +136,70 @@ class MintScraper(object):
     csv_url = "https://wwws.mint.com/transactionDownload.event?"
     user_agent = "Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.1.3) Gecko/20090824 Firefox/3.5.3 (.NET CLR 3.5.30729)"
 
-    def __init__(self):
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
-        self.opener.addheaders = [('User-Agent', self.user_agent)]
-        urllib2.install_opener(self.opener)
+    def __init__(self, session=None, parse_memos=True):
+        # Without a session, iter_transactions opens (and closes) its own.
+        self.session = session
+        self.parse_memos = parse_memos
 
     def parse(self, csv_stub):
         """
         Parse one row of mint.com's CSV dump format. ``csv_stub`` should be a
-        CSV string.
+        CSV string.  Given a file object instead (without its header row), 
+        parse the whole dump and return a list of transactions.
         """
+        if hasattr(csv_stub, 'read'):
+            return list(self.iter_parse(csv_stub, header=False))
         reader = csv.reader([csv_stub], delimiter=",", quotechar='"', quoting=csv.QUOTE_ALL)
         row = reader.next()
+        return self._transaction(row, csv_stub)
+
+    def iter_parse(self, lines, header=True, skip=None):
+        """
+        Parse a whole mint.com CSV dump, given as a file or an iterable of
+        lines (e.g. the download as it is read), yielding each transaction in
+        turn.  One csv reader is fed the whole stream, so quoted fields with
+        embedded newlines are read correctly.  The first row is skipped as a
+        header if ``header`` is true.  Rows for which ``skip(unique_id, date)``
+        is true are passed over without parsing their memos.
+        """
+        stub = []
+        def record(lines):
+            # Keep the raw line(s) of each row for its unique_id.
+            for line in lines:
+                stub.append(line)
+                yield line
+        reader = csv.reader(record(lines), delimiter=",", quotechar='"',
+                            quoting=csv.QUOTE_ALL)
+        if header:
+            next(reader, None)
+            del stub[:]
+        for row in reader:
+            raw = "".join(stub)
+            del stub[:]
+            if not row:
+                continue
+            if skip and skip(hashlib.sha1(raw).hexdigest(), _mint_date(row[0])):
+                continue
+            yield self._transaction(row, raw)
+
+    def parse_file(self, path, header=True, skip=None):
+        """
+        Yield the transactions of a mint.com CSV dump saved at ``path``
+        (optionally gzip-compressed), without logging in.
+        """
+        file = _open_export(path)
+        try:
+            for tx in self.iter_parse(file, header, skip):
+                yield tx
+        finally:
+            file.close()
 
+    def _transaction(self, row, csv_stub):
+        """ Build a transaction from a parsed ``row`` and its raw CSV. """
         tx = {'raw': {}}
-        tx_date = datetime.datetime.strptime(row[0], "%m/%d/%Y")
+        tx_date = _mint_date(row[0])
         # raw values
-        tx['raw']['date'] = tx_date.strftime("%Y-%m-%d")
+        tx['raw']['date'] = parser._format_date(tx_date)
         tx['raw']['description'] = row[1]
         tx['raw']['original_description'] = row[2]
         tx['raw']['amount'] = float(row[3])
@@ -128,57 +217,158 @@ class MintScraper(object):
             tx['amount'] = tx['raw']['amount'] 
         else:
             tx['amount'] = -tx['raw']['amount']
-        tx.update(parser.parse(tx['raw']['original_description'], tx_date))
+        if self.parse_memos:
+            tx.update(parser.parse(self.memo(tx), tx_date))
         return tx
 
-    def _build_request(self, url, referer=None):
-        req = urllib2.Request(url)
-        if referer:
-            req.add_header('Referer', referer)
-        return req
+    def memo(self, tx):
+        """ The memo string of a transaction, to be parsed. """
+        return tx['raw']['original_description']
+
+    def iter_transactions(self, username, password, skip=None):
+        """
+        Log in and yield parsed transactions as the CSV download is read.
+        """
+        headers = ["User-Agent: %s" % self.user_agent]
+        session = self.session or CurlSession()
+        try:
+            session.clear_cookies()
+            page = session.fetch(self.login_url, headers)
+            soup = BeautifulSoup(page)
+            form = soup.find(attrs={'id': "form-login"})
+            inputs = form.findAll('input')
+            data = {}
+            for input in inputs:
+                if input.has_key('name'):
+                    data[input['name']] = input['value']
+            data['username'] = username
+            data['password'] = password
+
+            params = urllib.urlencode(data)
+            page = session.fetch(self.login_post_url, headers, params)
+
+            lines = _lines(session.stream(self.csv_url, headers))
+            for tx in self.iter_parse(lines, skip=skip):
+                yield tx
+        finally:
+            if session is not self.session:
+                session.close()
 
     def get_transactions(self, username, password):
-        req = self._build_request(self.login_url)
-        page = self.opener.open(req).read()
-        soup = BeautifulSoup(page)
-        form = soup.find(attrs={'id': "form-login"})
-        inputs = form.findAll('input')
-        data = {}
-        for input in inputs:
-            if input.has_key('name'):
-                data[input['name']] = input['value']
-        data['username'] = username
-        data['password'] = password
-
-        params = urllib.urlencode(data)
-        f = self.opener.open(self.login_post_url, params)
-        page = f.read()
-
-        txs = self.opener.open(self.csv_url)
-        parsed = []
-        for line in txs.readlines()[1:]:
-            parsed.append(self.parse(line))
-        return parsed
+        return list(self.iter_transactions(username, password))
+
+class CurlSession(object):
+    """
+    A pycurl handle, and the multi handle that drives it, kept open across
+    requests so that connections (and TLS sessions) are reused.  Cookies are
+    kept in memory until ``clear_cookies``.  Not thread-safe: use one
+    session per thread.
+    """
+    def __init__(self):
+        self.curl = pycurl.Curl()
+        self.multi = pycurl.CurlMulti()
+
+    def clear_cookies(self):
+        self.curl.setopt(pycurl.COOKIELIST, "ALL")
+
+    def stream(self, url, headers=(), data=None):
+        """
+        Request ``url`` (a POST of ``data``, if given), following redirects,
+        and yield the body in chunks as they arrive rather than after the
+        whole response has been buffered.  HTTP errors raise pycurl.error.
+        """
+        curl = self.curl
+        # reset() keeps open connections and cookies, but not options.
+        curl.reset()
+        curl.setopt(pycurl.COOKIEFILE, "")
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.HTTPHEADER, list(headers))
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.FAILONERROR, 1)
+        if data is not None:
+            curl.setopt(pycurl.POSTFIELDS, data)
+        chunks = []
+        curl.setopt(pycurl.WRITEFUNCTION, chunks.append)
+        self.multi.add_handle(curl)
+        try:
+            while True:
+                ret, active = self.multi.perform()
+                while ret == pycurl.E_CALL_MULTI_PERFORM:
+                    ret, active = self.multi.perform()
+                received = chunks[:]
+                del chunks[:]
+                for chunk in received:
+                    yield chunk
+                if not active:
+                    break
+                self.multi.select(1.0)
+            queued, succeeded, failed = self.multi.info_read()
+            if failed:
+                handle, errno, message = failed[0]
+                raise pycurl.error(errno, message)
+        finally:
+            self.multi.remove_handle(curl)
+
+    def fetch(self, url, headers=(), data=None):
+        """ As ``stream``, but return the whole body. """
+        return "".join(self.stream(url, headers, data))
+
+    def close(self):
+        self.multi.close()
+        self.curl.close()
+
+def _lines(chunks):
+    """ Split a stream of string chunks into lines, as a file would. """
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if rest:
+        yield rest
+
+def _open_export(path):
+    """
+    Open a saved export for reading, decompressing it if it is gzipped.
+    """
+    file = open(path, 'rb')
+    magic = file.read(2)
+    file.seek(0)
+    if magic == "\x1f\x8b":
+        file = gzip.GzipFile(fileobj=file, mode='rb')
+    return file
 
 class WesabeScraper(object):
+    transactions_url = "https://www.wesabe.com/transactions.xml"
     tx_re = re.compile("<txaction>((?:.(?!</txaction>))*.)</txaction>", re.DOTALL)
     merchant_re = re.compile("<merchant>([^<]*)</merchant>", re.DOTALL)
     tags_re = re.compile("<tags>([^<]*)</tags>", re.DOTALL)
     name_re = re.compile("<name>([^<]*)</name>", re.DOTALL)
     transfer_re = re.compile("<transfer>\s*<guid>\s*([^<]*)\s*</guid>\s*</transfer>")
     entity_re = re.compile(r'&(#?)(x?)(\w+);')
+    # Any element holding only text, e.g. <date type="date">2009-11-30</date>.
+    element_re = re.compile(r"<([\w-]+)(?:\s+[^>]*)?>([^<]*)</\1>")
+
+    def __init__(self, session=None, parse_memos=True):
+        # Without a session, iter_transactions opens (and closes) its own.
+        self.session = session
+        self.parse_memos = parse_memos
 
     def _re_xml_parse(self, field_attr_func_list, dictobj, xml_stub):
         """ Simple regex xml parsing.  Because it's easier than DOM. """
+        # One scan for all the text elements; the first of each name wins,
+        # as a search for each field would find it.
+        elements = {}
+        for name, text in self.element_re.findall(xml_stub):
+            if name not in elements:
+                elements[name] = text
         for field, attr, func in field_attr_func_list:
-            match = re.search("<%(field)s(?:\s+[^>]*)?>([^<]*)</%(field)s>" % \
-                    {'field': field}, 
-                xml_stub, re.DOTALL)
-            if match:
+            if field in elements:
                 if func:
-                    dictobj[attr] = func(match.group(1))
+                    dictobj[attr] = func(elements[field])
                 else:
-                    dictobj[attr] = match.group(1)
+                    dictobj[attr] = elements[field]
 
     def _bash_amount(self, amount):
         amount = amount.replace("$", "")
@@ -187,77 +377,149 @@ class WesabeScraper(object):
         else:
             return float(amount)
 
+    def _fields(self):
+        """ The (element, raw field, conversion) of each field of a <txaction>. """
+        return (
+            ('guid', 'guid', None), 
+            ('account-id', 'account_id', int),
+            ('date', 'date', _iso_date),
+            ('original-date', 'original_date', _iso_date),
+            ('amount', 'amount', float),
+            ('display-name', 'display_name', self._decode_htmlentities),
+            ('raw-name', 'raw_name', None),
+            ('raw-txntype', 'raw_txntype', None),
+            ('memo', 'memo', self._decode_htmlentities),
+            ('check-number', 'check_number', int),
+        )
+
     def parse(self, xml_stub):
         """ 
         Parse one transaction from Wesabe's XML transaction export format.
         ``xml_stub`` should be a string containing <txaction>...</txaction>.
         """
-        tx = {'raw': {}}
+        return self._transaction(self._raw(xml_stub))
 
-        # raw fields
-        self._re_xml_parse((
-                ('guid', 'guid', None), 
-                ('account-id', 'account_id', lambda i: int(i)),
-                ('date', 'date', 
-                    lambda x: datetime.datetime.strptime(x, "%Y-%m-%d")),
-                ('original-date', 'original_date', 
-                    lambda x: datetime.datetime.strptime(x, "%Y-%m-%d")),
-                ('amount', 'amount', lambda f: float(f)),
-                ('display-name', 'display_name', self._decode_htmlentities),
-                ('raw-name', 'raw_name', None),
-                ('raw-txntype', 'raw_txntype', None),
-                ('memo', 'memo', self._decode_htmlentities),
-                ('check-number', 'check_number', lambda i: int(i)),
-            ), tx['raw'], xml_stub)
-        tx_date = tx['raw']['date']
-        tx['raw']['date'] = tx['raw']['date'].strftime("%Y-%m-%d")
-        tx['raw']['original_date'] = tx['raw']['original_date'].strftime("%Y-%m-%d")
+    def _raw(self, xml_stub):
+        """ The raw fields of a <txaction>. """
+        raw = {}
+        self._re_xml_parse(self._fields(), raw, xml_stub)
 
         match = self.merchant_re.search(xml_stub)
         if match:
             self._re_xml_parse((
                     ('id', 'merchant_id', None),
                     ('name', 'merchant_name', None)
-                ), tx['raw'], match.group(1))
+                ), raw, match.group(1))
         match = self.tags_re.search(xml_stub)
         if match:
             tags = self.name_re.findall(match.group(1))
-            tx['raw']['tags'] = ",".join(tags)
+            raw['tags'] = ",".join(tags)
+        return raw
+
+    def _transaction(self, raw):
+        """ Build a transaction from the raw fields of a <txaction>. """
+        tx = {'raw': raw}
+        tx_date = tx['raw']['date']
+        tx['raw']['date'] = parser._format_date(tx['raw']['date'])
+        tx['raw']['original_date'] = parser._format_date(
+                tx['raw']['original_date'])
 
         # Parsed values
         tx['unique_id'] = tx['raw']['guid']
         tx['data_source'] = "wesabe"
         tx['date'] = tx['raw']['date']
         tx['amount'] = tx['raw']['amount']
+        # set channel, channel_details, and vendor
+        if self.parse_memos:
+            tx.update(parser.parse(self.memo(tx), tx_date))
+        return tx
+
+    def memo(self, tx):
+        """ The memo string of a transaction, to be parsed. """
         if tx['raw'].has_key('check_number'):
-            memo = "SH DRAFT# %s" % tx['raw']['check_number']
+            return "SH DRAFT# %s" % tx['raw']['check_number']
         elif tx['raw'].has_key('memo'):
-            memo = "%s /  %s" % (tx['raw']['raw_name'], 
+            return "%s /  %s" % (tx['raw']['raw_name'], 
                     tx['raw']['memo'])
         else:
-            memo = tx['raw'].get('raw_name', tx['raw']['display_name'])
-        # set channel, channel_details, and vendor
-        tx.update(parser.parse(memo, tx_date))
-        return tx
+            return tx['raw'].get('raw_name', tx['raw']['display_name'])
 
-    def get_transactions(self, username, password):
+    def _split_txactions(self, chunks):
+        """
+        Yield the contents of each <txaction>...</txaction> element in the
+        stream of XML ``chunks``, as ``tx_re`` would find them in the joined
+        document, as soon as each element is complete.
+        """
+        start_tag, end_tag = "<txaction>", "</txaction>"
+        buffer = ""
+        for chunk in chunks:
+            buffer += chunk
+            pos = 0
+            while True:
+                start = buffer.find(start_tag, pos)
+                if start == -1:
+                    # Keep what might be the beginning of a start tag.
+                    pos = max(pos, len(buffer) - len(start_tag) + 1)
+                    break
+                end = buffer.find(end_tag, start + len(start_tag))
+                if end == -1:
+                    pos = start
+                    break
+                if end > start + len(start_tag):
+                    yield buffer[start + len(start_tag):end]
+                pos = end + len(end_tag)
+            buffer = buffer[pos:]
+
+    def iter_parse(self, chunks, skip=None):
+        """
+        Parse a whole Wesabe XML export, given as a file or an iterable of
+        string chunks (e.g. the body of a response as it arrives), giving the
+        same transactions as ``parse`` does for each <txaction>.  Yields each
+        transaction as soon as its </txaction> has been read, so memory use
+        stays flat.  Transactions for which ``skip(unique_id, date)`` is true
+        are not parsed further.
+        """
+        if hasattr(chunks, 'read'):
+            file = chunks
+            chunks = iter(lambda: file.read(65536), "")
+        for xml_stub in self._split_txactions(chunks):
+            raw = self._raw(xml_stub)
+            if skip and skip(raw['guid'], raw['date']):
+                continue
+            yield self._transaction(raw)
+
+    def parse_file(self, path, skip=None):
+        """
+        Yield the transactions of a Wesabe XML export saved at ``path``
+        (optionally gzip-compressed), without logging in.
+        """
+        file = _open_export(path)
+        try:
+            for tx in self.iter_parse(file, skip=skip):
+                yield tx
+        finally:
+            file.close()
+
+    def iter_transactions(self, username, password, skip=None):
+        """
+        Yield parsed transactions as the XML export is downloaded.
+        """
         credentials = base64.encodestring('%s:%s' % (username, password))[:-1]
-        c = pycurl.Curl()
-        c.setopt(pycurl.URL, "https://www.wesabe.com/transactions.xml")
-        c.setopt(pycurl.HTTPHEADER, ["Accept: application/xml",
-                                     "User-Agent: GrockTxServer/0.1",
-                                     "Authorization: Basic %s" % credentials])
-        s = StringIO.StringIO()
-        c.setopt(pycurl.WRITEFUNCTION, s.write)
-        c.perform()
-        response = s.getvalue()
-        c.close()
-
-        parsed = []
-        tx_xml = self.tx_re.findall(response)
-        for xml in tx_xml:
-            parsed.append(self.parse(xml))
-        return parsed
+        headers = ["Accept: application/xml",
+                   "User-Agent: GrockTxServer/0.1",
+                   "Authorization: Basic %s" % credentials]
+        session = self.session or CurlSession()
+        try:
+            session.clear_cookies()
+            chunks = session.stream(self.transactions_url, headers)
+            for tx in self.iter_parse(chunks, skip=skip):
+                yield tx
+        finally:
+            if session is not self.session:
+                session.close()
+
+    def get_transactions(self, username, password):
+        return list(self.iter_transactions(username, password))
 
     @classmethod
     def _decode_htmlentities(cls, string):
@@ -279,21 +541,222 @@ class WesabeScraper(object):
             else:
                 return match.group()
 
+def iter_transactions(provider, username, password, skip=None):
+    """
+    Yield parsed transactions from ``provider`` as its export is downloaded,
+    without holding the whole export in memory.  Transactions for which
+    ``skip(unique_id, date)`` is true are left out before their memos are
+    parsed.
+    """
+    if provider == "wesabe":
+        return WesabeScraper().iter_transactions(username, password, skip)
+    elif provider == "mint":
+        return MintScraper().iter_transactions(username, password, skip)
+    else:
+        sys.stderr.write("Provider %s not supported" % provider)
+        return iter([])
+
 def get_transactions(provider, username, password):
+    return list(iter_transactions(provider, username, password))
+
+def iter_file(provider, path, skip=None):
+    """
+    Yield parsed transactions from an export of ``provider`` saved at
+    ``path``, which may be gzip-compressed.
+    """
     if provider == "wesabe":
-        return WesabeScraper().get_transactions(username, password)
+        return WesabeScraper().parse_file(path, skip=skip)
     elif provider == "mint":
-        return MintScraper().get_transactions(username, password)
+        return MintScraper().parse_file(path, skip=skip)
     else:
         sys.stderr.write("Provider %s not supported" % provider)
-        return []
+        return iter([])
 
-if __name__ == "__main__":
+class SyncState(object):
+    """
+    What has already been synced, per provider and account, kept in a SQLite
+    file at ``path``: the ``unique_id`` and date of each transaction seen, and
+    the latest date seen.  Ids dated more than ``window`` days before the
+    latest date are forgotten, and transactions that old are assumed to have
+    been synced already; the window allows for transactions that post late.
+    """
+    def __init__(self, path, window=30):
+        self.path = path
+        self.window = datetime.timedelta(window)
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                provider TEXT, account TEXT, latest_date TEXT,
+                PRIMARY KEY (provider, account));
+            CREATE TABLE IF NOT EXISTS sync_seen (
+                provider TEXT, account TEXT, unique_id TEXT, date TEXT,
+                PRIMARY KEY (provider, account, unique_id));
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def latest_date(self, provider, account):
+        """ The latest transaction date (YYYY-MM-DD) synced, or None. """
+        row = self.db.execute("SELECT latest_date FROM sync_state "
+                "WHERE provider = ? AND account = ?",
+                (provider, account)).fetchone()
+        return row[0] if row else None
+
+    def seen(self, provider, account):
+        """ The set of unique_ids synced within the window. """
+        return set(row[0] for row in self.db.execute(
+                "SELECT unique_id FROM sync_seen "
+                "WHERE provider = ? AND account = ?", (provider, account)))
+
+    def skip(self, provider, account):
+        """
+        A ``skip(unique_id, date)`` function for the scrapers which is true
+        for transactions that have already been synced.
+        """
+        seen = self.seen(provider, account)
+        latest = self.latest_date(provider, account)
+        if latest is None:
+            return lambda unique_id, date: unique_id in seen
+        cutoff = _iso_date(latest) - self.window
+        return lambda unique_id, date: date < cutoff or unique_id in seen
+
+    def record(self, provider, account, transactions):
+        """
+        Mark ``transactions`` (dicts with 'unique_id' and 'date', or
+        (unique_id, date) pairs) as synced, and forget the ids that have
+        fallen out of the window.
+        """
+        rows = [(tx['unique_id'], tx['date']) if isinstance(tx, dict) else tx
+                for tx in transactions]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO sync_seen "
+                    "(provider, account, unique_id, date) VALUES (?, ?, ?, ?)",
+                    [(provider, account, unique_id, date)
+                     for unique_id, date in rows])
+            latest = max([date for unique_id, date in rows] +
+                         filter(None, [self.latest_date(provider, account)]))
+            self.db.execute("INSERT OR REPLACE INTO sync_state "
+                    "(provider, account, latest_date) VALUES (?, ?, ?)",
+                    (provider, account, latest))
+            cutoff = parser._format_date(_iso_date(latest) - self.window)
+            self.db.execute("DELETE FROM sync_seen WHERE provider = ? AND "
+                    "account = ? AND date < ?", (provider, account, cutoff))
+
+def iter_sync(state, provider, username, password=None, path=None):
+    """
+    Yield only the transactions from ``provider`` that are not yet recorded
+    in ``state`` (a ``SyncState``) for the account ``username``; rows that
+    were synced before are skipped without parsing their memos.  The export
+    is downloaded, or read from ``path`` if given.  The new transactions are
+    recorded once they have all been yielded, so an interrupted sync is
+    simply repeated next time.
+    """
+    skip = state.skip(provider, username)
+    if path:
+        transactions = iter_file(provider, path, skip)
+    else:
+        transactions = iter_transactions(provider, username, password, skip)
+    synced = []
+    for tx in transactions:
+        synced.append((tx['unique_id'], tx['date']))
+        yield tx
+    if synced:
+        state.record(provider, username, synced)
+
+PROVIDERS = {
+    'mint': MintScraper,
+    'wesabe': WesabeScraper,
+}
+
+def _account_worker(jobs, results, providers):
+    session = CurlSession()
     try:
-        provider, username, password = sys.argv[1:4]
+        while True:
+            try:
+                index, (provider, username, password) = jobs.get_nowait()
+            except Queue.Empty:
+                break
+            result = {'job': index, 'provider': provider,
+                      'username': username, 'transactions': None,
+                      'error': None}
+            start = time.time()
+            try:
+                if provider not in providers:
+                    raise ValueError("Provider %s not supported" % provider)
+                scraper = providers[provider](session)
+                result['transactions'] = list(
+                        scraper.iter_transactions(username, password))
+            except Exception, e:
+                result['error'] = "%s: %s" % (e.__class__.__name__, e)
+            result['seconds'] = time.time() - start
+            results.put(result)
+    finally:
+        session.close()
+
+def iter_accounts(jobs, workers=4, providers=None):
+    """
+    Scrape many accounts at once.  ``jobs`` is a list of (provider, username,
+    password) tuples, run on at most ``workers`` threads.  Each thread reuses
+    one CurlSession, and so its open connections, for all of its jobs,
+    clearing the cookies between them.  Yields a dict per job as it finishes:
+        {'job': index in jobs, 'provider': ..., 'username': ...,
+         'transactions': list, or None on error,
+         'error': None, or the error message,
+         'seconds': time taken}
+    ``providers`` maps provider names to scraper classes (default
+    ``PROVIDERS``).
+    """
+    providers = providers or PROVIDERS
+    queue = Queue.Queue()
+    for job in enumerate(jobs):
+        queue.put(job)
+    count = queue.qsize()
+    results = Queue.Queue()
+    for i in xrange(min(workers, count)):
+        thread = threading.Thread(target=_account_worker,
+                                  args=(queue, results, providers))
+        thread.daemon = True
+        thread.start()
+    for i in xrange(count):
+        yield results.get()
+
+def main(argv=None):
+    usage = ("usage: %prog <provider> <username> <password>\n"
+             "       %prog --from-file <path> <provider>")
+    opts = optparse.OptionParser(usage=usage, description="Print the "
+            "transactions from a provider (mint or wesabe) as JSON, either "
+            "scraped live or read from a saved export.")
+    opts.add_option("--from-file", metavar="PATH",
+            help="parse the provider's export saved at PATH (optionally "
+                 "gzipped) instead of logging in")
+    opts.add_option("--sync-state", metavar="DB",
+            help="only print transactions not yet recorded in the SQLite "
+                 "file DB, and record them there")
+    opts.add_option("--account",
+            help="the account to keep sync state for (default: username)")
+    options, args = opts.parse_args(argv)
+    if options.from_file:
+        if len(args) != 1:
+            opts.error("expected a provider")
+        provider, username, password = args[0], None, None
+    else:
+        if len(args) != 3:
+            opts.error("expected a provider, username and password")
+        provider, username, password = args
+    if options.sync_state:
+        state = SyncState(options.sync_state)
+        try:
+            results = list(iter_sync(state, provider,
+                options.account or username or "", password,
+                options.from_file))
+        finally:
+            state.close()
+    elif options.from_file:
+        results = list(iter_file(provider, options.from_file))
+    else:
         results = get_transactions(provider, username, password)
-        print json.dumps(results, indent=4)
-    except ValueError:
-        sys.stderr.write(
-            "Usage: %s <provider> <username> <password>" % __file__)
-        sys.exit(1)
+    print json.dumps(results, indent=4)
+
+if __name__ == "__main__":
+    main()
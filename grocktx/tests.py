@@ -1,9 +1,25 @@
+import os
+import time
+import sys
+import csv
+import gzip
+import shutil
+import StringIO
+import datetime
+import tempfile
 import unittest
 import getpass
 import json
+import base64
+import urllib2
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import hashlib
 import pprint
 
-import parser, scraper
+import parser, scraper, zipdata, grocktx_server_client, pipeline, benchmark
 
 p = parser.parse
 
@@ -222,6 +238,966 @@ class TestParser(unittest.TestCase):
                     )
                 )
 
+    def test_examples(self):
+        # The examples' dates lack years; pin the reference date so they
+        # resolve to 2009 whenever the tests are run.
+        date = datetime.datetime(2010, 1, 1)
+        for channel, tests in sorted(examples.iteritems()):
+            for memo, goal in tests:
+                actual = parser.parse(memo, date)
+                self.assertEqual(actual, goal,
+                    "'%s': '%s'\nGOT: %s\nWANTED: %s" % (
+                        channel, memo, actual, goal))
+
+class TestParseMany(unittest.TestCase):
+    def test_parse_many(self):
+        date = datetime.datetime(2010, 1, 1)
+        memos = [memo for channel, tests in sorted(examples.iteritems())
+                      for memo, goal in tests]
+        expected = [parser.parse(memo, date) for memo in memos]
+        results = parser.parse_many(memo for memo in memos)
+        self.assertEqual(results.next(), parser.parse(memos[0]))
+        self.assertEqual(list(parser.parse_many(iter(memos), date)), expected)
+        self.assertEqual(list(parser.parse_many(memos, [date] * len(memos))),
+                         expected)
+
+    def test_parse_parallel(self):
+        date = datetime.datetime(2010, 1, 1)
+        memos = [memo for channel, tests in sorted(examples.iteritems())
+                      for memo, goal in tests] * 3
+        expected = [parser.parse(memo, date) for memo in memos]
+        stats = {}
+        results = parser.parse_parallel(iter(memos), date, workers=2,
+                                        chunksize=4, stats=stats)
+        self.assertEqual(list(results), expected)
+        self.assertEqual(stats['memos'], len(memos))
+        self.assertEqual(stats['workers'], 2)
+
+    def test_mismatched_dates(self):
+        date = datetime.datetime(2010, 1, 1)
+        memos = ['SH DRAFT# 1', 'SH DRAFT# 2', 'SH DRAFT# 3']
+        self.assertRaises(ValueError, list, parser.parse_many(memos, [date]))
+        self.assertRaises(ValueError, list,
+                          parser.parse_many(memos[:1], [date] * 3))
+        self.assertRaises(ValueError, list,
+                          parser.parse_parallel(memos, [date], workers=1))
+
+class TestCompact(unittest.TestCase):
+    def test_compact(self):
+        date = datetime.datetime(2010, 1, 1)
+        for channel, tests in examples.iteritems():
+            for memo, goal in tests:
+                compact = parser.parse(memo, date, compact=True)
+                self.assertEqual(compact.as_dict(), parser.parse(memo, date))
+                self.assertEqual(compact.channel, goal['channel'])
+                self.assertEqual(compact.vendor.description,
+                                 goal['vendor']['description'])
+
+    def test_compact_many(self):
+        date = datetime.datetime(2010, 1, 1)
+        memos = [memo for channel, tests in sorted(examples.iteritems())
+                      for memo, goal in tests]
+        expected = [parser.parse(memo, date) for memo in memos]
+        for results in (parser.parse_many(memos, date, compact=True),
+                        parser.parse_parallel(memos, date, workers=2,
+                                              chunksize=4, compact=True)):
+            self.assertEqual([r.as_dict() for r in results], expected)
+
+class TestColumns(unittest.TestCase):
+    def setUp(self):
+        self.date = datetime.datetime(2010, 1, 1)
+        self.memos = [memo for channel, tests in sorted(examples.iteritems())
+                           for memo, goal in tests]
+        self.expected = [parser.parse(memo, self.date) for memo in self.memos]
+
+    def test_columns(self):
+        columns = parser.parse_columns(iter(self.memos), self.date)
+        for i, parsed in enumerate(self.expected):
+            details = parsed.get('channel_details', {})
+            self.assertEqual(parser.CHANNEL_CODES[columns['channel'][i]],
+                             parsed['channel'])
+            self.assertEqual(columns['description'][i],
+                             parsed['vendor']['description'])
+            self.assertEqual(columns['city'][i], parsed['vendor']['city'])
+            self.assertEqual(columns['state'][2 * i:2 * i + 2].tostring(),
+                             parsed['vendor']['state'].ljust(2))
+            self.assertEqual(columns['zip'][5 * i:5 * i + 5].tostring(),
+                             parsed['vendor']['zip'].ljust(5))
+            self.assertEqual(columns['auth'][i], details.get('auth', ""))
+            if 'auth_date' in details:
+                self.assertEqual(
+                    datetime.date.fromordinal(columns['auth_date'][i]),
+                    datetime.datetime.strptime(details['auth_date'],
+                                               "%Y-%m-%d").date())
+            if 'auth_time' in details:
+                self.assertEqual("%02d:%02d" % divmod(columns['auth_time'][i],
+                                                      60),
+                                 details['auth_time'])
+            if 'amount' in details:
+                self.assertEqual(columns['amount'][i], details['amount'])
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        rows = parser.parse_columns(self.memos, self.date, as_numpy=True)
+        self.assertEqual(len(rows), len(self.expected))
+        for row, parsed in zip(rows, self.expected):
+            self.assertEqual(parser.CHANNEL_CODES[row['channel']],
+                             parsed['channel'])
+            self.assertEqual(row['state'], parsed['vendor']['state'])
+            self.assertEqual(row['zip'], parsed['vendor']['zip'])
+
+class TestCommandLine(unittest.TestCase):
+    def run_main(self, argv, input):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, argv.pop())
+        stdout = sys.stdout
+        try:
+            with open(path, 'wb') as file:
+                file.write(input)
+            sys.stdout = StringIO.StringIO()
+            parser.main(argv + [path])
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(tmpdir)
+
+    def test_jsonl(self):
+        memo = 'WITHDRAW#  - POS 1128 1756 531470 HARVEST COOP CAMBRIDGE MA'
+        output = self.run_main(["memos.jsonl"],
+            '"SH DRAFT# 1121"\n{"memo": "%s", "date": "2009-12-01"}\n' % memo)
+        lines = [json.loads(line) for line in output.splitlines()]
+        expected = parser.parse(memo, datetime.datetime(2009, 12, 1))
+        expected['memo'] = memo
+        self.assertEqual(lines[1], expected)
+        self.assertEqual(lines[0]['channel'], 'check')
+
+    def test_csv(self):
+        output = self.run_main(["--header", "-o", "csv", "memos.csv"],
+            'memo,date\n"SH DRAFT# 1121",2009-12-01\nDEPOSIT\n')
+        rows = list(csv.reader(StringIO.StringIO(output)))
+        self.assertEqual(tuple(rows[0]), parser.CSV_FIELDS)
+        self.assertEqual(rows[1][:3], ["SH DRAFT# 1121", "check", "CHECK 1121"])
+        self.assertEqual(rows[2][:3], ["DEPOSIT", "deposit", "deposit"])
+
+class TestMemoCache(unittest.TestCase):
+    def setUp(self):
+        self.maxsize = parser.memo_cache.maxsize
+        parser.memo_cache.clear()
+        parser.memo_cache.resize(2)
+
+    def tearDown(self):
+        parser.memo_cache.clear()
+        parser.memo_cache.resize(self.maxsize)
+
+    def test_memo_cache(self):
+        memo = 'PURCHASE#  - 11-25-09 SAVENORS MARKET BOSTON MA auth# 60618'
+        first = parser.parse(memo)
+        first['vendor']['city'] = 'CHANGED'
+        second = parser.parse(memo)
+        self.assertEqual(second['vendor']['city'], 'BOSTON')
+        stats = parser.memo_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        parser.parse('SH DRAFT# 1')
+        parser.parse('SH DRAFT# 2')
+        self.assertEqual(parser.memo_cache.stats()['evictions'], 1)
+        self.assertEqual(parser.memo_cache.stats()['size'], 2)
+
+    def test_pos_memos_not_cached(self):
+        memo = 'WITHDRAW#  - POS 1128 1756 531470 HARVEST COOP CAMBRIDGE MA'
+        for year in (2009, 2010, 2012):
+            parsed = parser.parse(memo, datetime.datetime(year, 11, 1))
+            self.assertEqual(parsed['channel_details']['auth_date'],
+                             '%s-11-28' % year)
+        parser.parse(memo)
+        parser.parse(memo)
+        stats = parser.memo_cache.stats()
+        self.assertEqual((stats['size'], stats['hits']), (0, 0))
+
+    def test_off_by_default(self):
+        self.assertEqual(self.maxsize, 0)
+
+    def test_disabled(self):
+        parser.memo_cache.resize(0)
+        parser.parse('SH DRAFT# 1')
+        parser.parse('SH DRAFT# 1')
+        self.assertEqual(parser.memo_cache.stats()['size'], 0)
+        self.assertEqual(parser.memo_cache.stats()['hits'], 0)
+
+class TestVendorCache(unittest.TestCase):
+    def setUp(self):
+        self.maxsizes = (parser.memo_cache.maxsize,
+                         parser.vendor_cache.maxsize)
+        parser.memo_cache.resize(0)
+        parser.vendor_cache.clear()
+
+    def tearDown(self):
+        parser.vendor_cache.clear()
+        parser.memo_cache.resize(self.maxsizes[0])
+        parser.vendor_cache.resize(self.maxsizes[1])
+
+    def test_vendor_cache(self):
+        date = datetime.datetime(2010, 1, 1)
+        first = parser.parse(
+            'WITHDRAW#  - POS 1128 1756 531470 HARVEST COOP CAMBRIDGE MA', date)
+        first['vendor']['city'] = 'CHANGED'
+        second = parser.parse(
+            'WITHDRAW#  - POS 1201 0900 531999 HARVEST COOP CAMBRIDGE MA', date)
+        self.assertEqual(second['vendor']['city'], 'CAMBRIDGE')
+        self.assertEqual(second['channel_details']['auth'], '531999')
+        stats = parser.vendor_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(parser.parse_vendor("  "), None)
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.sizes = (parser.memo_cache.maxsize, parser.vendor_cache.maxsize)
+        parser.memo_cache.resize(0)
+        parser.vendor_cache.resize(0)
+        parser.profile.reset()
+
+    def tearDown(self):
+        parser.profile.disable()
+        parser.profile.reset()
+        parser.memo_cache.resize(self.sizes[0])
+        parser.vendor_cache.resize(self.sizes[1])
+
+    def test_disabled(self):
+        p('WITHDRAW#  - POS 1128 1756 531470 HARVEST COOP CAMBRIDGE MA')
+        snapshot = parser.profile.snapshot()
+        self.assertFalse(snapshot['enabled'])
+        self.assertEqual(snapshot['memos'], 0)
+        self.assertEqual(snapshot['calls']['city'], 0)
+
+    def test_profile(self):
+        memos = [memo for memo, expected in examples['pos'] + examples['check']]
+        date = datetime.datetime(2010, 1, 1)
+        unprofiled = [p(memo, date) for memo in memos + ["", "WITHDRAW#  - ebill epayment"]]
+        parser.profile.enable()
+        profiled = [p(memo, date) for memo in memos + ["", "WITHDRAW#  - ebill epayment"]]
+        self.assertEqual(profiled, unprofiled)
+        snapshot = parser.profile.snapshot()
+        self.assertEqual(snapshot['memos'], len(memos) + 2)
+        self.assertEqual(sum(snapshot['branches'].values()), len(memos) + 2)
+        self.assertEqual(snapshot['branches']['check'],
+                         len(examples['check']))
+        self.assertEqual(snapshot['branches']['unknown'], 1)
+        self.assertEqual(snapshot['branches']['other'], 1)
+        self.assertTrue(snapshot['regexes_tried'] >= len(memos))
+        self.assertEqual(snapshot['calls']['regex'],
+                         snapshot['regexes_tried'])
+        self.assertTrue(snapshot['cities_scored'] > 0)
+        for stage in parser.StageProfile.STAGES:
+            self.assertTrue(snapshot['calls'][stage] > 0, stage)
+        self.assertTrue(snapshot['seconds']['parse_memo'] >=
+                        snapshot['seconds']['regex'])
+        parser.profile.reset()
+        self.assertEqual(parser.profile.snapshot()['memos'], 0)
+
+class TestDates(unittest.TestCase):
+    def test_pos_date(self):
+        for date_str, target, expected in (
+                ("1128 1756", datetime.datetime(2009, 12, 1),
+                    datetime.datetime(2009, 11, 28, 17, 56)),
+                ("1228 0101", datetime.datetime(2010, 1, 5),
+                    datetime.datetime(2009, 12, 28, 1, 1)),
+                ("0103 2359", datetime.datetime(2009, 12, 30),
+                    datetime.datetime(2010, 1, 3, 23, 59))):
+            self.assertEqual(parser.parse_pos_date(date_str, target), expected)
+        for date_str in ("1332 1200", "0101 2500", "01011200", "01a1 1200"):
+            self.assertRaises(ValueError, parser.parse_pos_date, date_str,
+                              datetime.datetime(2010, 1, 1))
+
+    def test_cc_date(self):
+        self.assertEqual(parser.parse_cc_date("11-25-09"), "2009-11-25")
+        self.assertEqual(parser.parse_cc_date("12-31-99"), "1999-12-31")
+        self.assertEqual(parser.parse_cc_date("02-29-08"), "2008-02-29")
+        for date_str in ("02-29-09", "13-01-09", "1-1-2009"):
+            self.assertRaises(ValueError, parser.parse_cc_date, date_str)
+
+class TestParseCity(unittest.TestCase):
+    def test_city_index(self):
+        cities = ["BOSTON", "CAMBRIDGE", "BOSTON", "JAMAICA PLAIN",
+                  "UNIVERSITY CITY"]
+        for memo, goal in (
+                ("HARVEST COOP CAMBRIDGE", ("HARVEST COOP", "CAMBRIDGE")),
+                ("CLOVER JAMAICA PLAIN", ("CLOVER", "JAMAICA PLAIN")),
+                ("TIVOLI UNIVERSITYCTY", ("TIVOLI", "UNIVERSITY CITY")),
+                ("NOWHERE", ("NOWHERE", ""))):
+            self.assertEqual(parser.parse_city(cities, memo), goal)
+            self.assertEqual(
+                parser.parse_city(parser.CityIndex(cities), memo), goal)
+
+    def test_ties_go_to_first_city(self):
+        self.assertEqual(parser.parse_city(["BOSTONX", "BOSTONY"], "A BOSTON"),
+                         ("A", "BOSTONX"))
+        self.assertEqual(parser.parse_city(["BOSTONY", "BOSTONX"], "A BOSTON"),
+                         ("A", "BOSTONY"))
+
+class TestCorpus(unittest.TestCase):
+    def test_corpus(self):
+        memos = benchmark.corpus(500)
+        self.assertEqual(memos, benchmark.corpus(500))
+        self.assertNotEqual(memos, benchmark.corpus(500, seed=1))
+        channels = set(p(memo, date)['channel'] for memo, date in memos)
+        for channel in ("pos", "atm", "check", "transfer", "deposit",
+                        "dividend", "fee", "rev fee", "withdraw"):
+            self.assertTrue(channel in channels, channel)
+        located = [p(memo, date)['vendor'] for memo, date in memos
+                   if memo.startswith("WITHDRAW#  - POS")]
+        self.assertTrue(sum(1 for v in located if v['city']) >
+                        len(located) / 2)
+
+    def test_child_dies(self):
+        benchmark.BENCHMARKS['dies'] = lambda: os._exit(3)
+        try:
+            self.assertRaises(RuntimeError, benchmark.run, 'dies')
+        finally:
+            del benchmark.BENCHMARKS['dies']
+
+class TestZipData(unittest.TestCase):
+    def test_unique_cities(self):
+        counts = parser.zip_data().counts()
+        self.assertTrue(counts['state_cities'] < counts['rows'])
+        for state, cities in parser.zip_data().cities_by_state.iteritems():
+            self.assertEqual(len(cities), len(set(cities)), state)
+        self.assertEqual(parser.zip_data().cities_by_zip['02139'], ['CAMBRIDGE'])
+        # The old module-level name still works.
+        self.assertEqual(parser.ZIP.cities_by_zip['02139'], ['CAMBRIDGE'])
+
+    def test_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        class TmpZipData(zipdata.ZipData):
+            ZIP_CITY_CACHE = os.path.join(tmpdir, "zips.marshal")
+        try:
+            fresh = TmpZipData()
+            self.assertTrue(os.path.exists(TmpZipData.ZIP_CITY_CACHE))
+            cached = TmpZipData()
+            self.assertEqual(cached.counts(), fresh.counts())
+            self.assertEqual(cached.cities_by_state, fresh.cities_by_state)
+
+            # Stale or corrupt caches are rebuilt from the csv.
+            with open(TmpZipData.ZIP_CITY_CACHE, 'wb') as file:
+                file.write("garbage")
+            self.assertEqual(TmpZipData().counts(), fresh.counts())
+            self.assertEqual(TmpZipData().counts(), fresh.counts())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_mapped(self):
+        tmpdir = tempfile.mkdtemp()
+        class TmpMappedZipData(zipdata.MappedZipData):
+            ZIP_CITY_MAP = os.path.join(tmpdir, "zips.map")
+        try:
+            dicts = parser.zip_data()
+            mapped = TmpMappedZipData()
+            self.assertEqual(mapped.counts(), dicts.counts())
+            for zip in ('00501', '02139', '99950', '00000', '99999'):
+                self.assertEqual(mapped.zip_city(zip), dicts.zip_city(zip))
+            self.assertEqual(mapped.city_index('XX'), None)
+            for state in ('MA', 'MO', 'TX'):
+                index = mapped.city_index(state)
+                expected = dicts.city_index(state)
+                self.assertEqual(index.lengths, expected.lengths)
+                for length in index.lengths:
+                    self.assertEqual(list(index.groups[length]),
+                                     expected.groups[length])
+            self.assertEqual(
+                parser.parse_city(mapped.city_index('MO'),
+                                  "TIVOLI 258 00002QPS UNIVERSITYCTY"),
+                ("TIVOLI 258 00002QPS", "UNIVERSITY CITY"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+MINT_CSV = (
+    '"Date","Description","Original Description","Amount",'
+    '"Transaction Type","Category","Account Name","Labels","Notes"\n'
+    '"11/30/2009","Harvest Co-op","POS 1128 1756 495524 HARVEST COOP '
+    'CAMBRIDGE MA","23.56","debit","Groceries","Checking","",""\n'
+    '"12/01/2009","Payroll","DIRECT DEPOSIT ACME CORP PAYROLL","1500.00",'
+    '"credit","Paycheck","Checking","","two\nlines"\n'
+    '"12/02/2009","Check","CHECK 1234","40.00","debit","Rent","Checking",'
+    '"",""\n'
+)
+
+class TestMint(unittest.TestCase):
+    def test_iter_parse(self):
+        mint = scraper.MintScraper()
+        lines = MINT_CSV.splitlines(True)
+        txs = list(mint.iter_parse(StringIO.StringIO(MINT_CSV)))
+        self.assertEqual(len(txs), 3)
+        self.assertEqual(txs[0], mint.parse(lines[1]))
+        self.assertEqual(txs[2], mint.parse(lines[4]))
+        self.assertEqual(txs[1]['raw']['notes'], "two\nlines")
+        self.assertEqual(txs[1]['amount'], 1500.0)
+        self.assertEqual(txs[1]['unique_id'],
+                         hashlib.sha1(lines[2] + lines[3]).hexdigest())
+        self.assertEqual(txs[0]['date'], "2009-11-30")
+        self.assertEqual(txs[0]['amount'], -23.56)
+
+    def test_parse_file(self):
+        mint = scraper.MintScraper()
+        body = MINT_CSV.split("\n", 1)[1]
+        self.assertEqual(mint.parse(StringIO.StringIO(body)),
+                         list(mint.iter_parse(MINT_CSV.splitlines(True))))
+
+    def test_saved_export(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "transactions.csv.gz")
+            file = gzip.open(path, 'wb')
+            file.write(MINT_CSV)
+            file.close()
+            expected = list(scraper.MintScraper().iter_parse(
+                    MINT_CSV.splitlines(True)))
+            # Saved exports are parsed without opening any connection.
+            def no_network():
+                raise AssertionError("opened a CurlSession")
+            curl_session = scraper.CurlSession
+            scraper.CurlSession = no_network
+            try:
+                mint = scraper.MintScraper()
+                self.assertEqual(list(mint.parse_file(path)), expected)
+                self.assertEqual(list(scraper.iter_file("mint", path)),
+                                 expected)
+            finally:
+                scraper.CurlSession = curl_session
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = scraper.SyncState(os.path.join(self.tmpdir, "sync.db"))
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tmpdir)
+
+    def sync(self, csv):
+        path = os.path.join(self.tmpdir, "transactions.csv")
+        with open(path, 'wb') as file:
+            file.write(csv)
+        return list(scraper.iter_sync(self.state, "mint", "me", path=path))
+
+    def test_sync(self):
+        self.assertEqual(len(self.sync(MINT_CSV)), 3)
+        self.assertEqual(self.state.latest_date("mint", "me"), "2009-12-02")
+        self.assertEqual(self.sync(MINT_CSV), [])
+        new_row = ('"12/03/2009","Check","CHECK 1235","40.00","debit",'
+                   '"Rent","Checking","",""\n')
+        txs = self.sync(MINT_CSV + new_row)
+        self.assertEqual([tx['date'] for tx in txs], ["2009-12-03"])
+        # Other accounts are synced separately.
+        self.assertEqual(self.state.seen("mint", "you"), set())
+
+    def test_window(self):
+        self.state.record("mint", "me", [("a", "2009-01-01"),
+                                         ("b", "2009-03-01")])
+        self.assertEqual(self.state.seen("mint", "me"), set(["b"]))
+        skip = self.state.skip("mint", "me")
+        self.assertTrue(skip("a", datetime.datetime(2009, 1, 1)))
+        self.assertTrue(skip("b", datetime.datetime(2009, 3, 1)))
+        self.assertFalse(skip("c", datetime.datetime(2009, 2, 20)))
+
+WESABE_TXACTION = """<txaction>
+    <guid>%(guid)s</guid>
+    <account-id type="integer">1</account-id>
+    <date type="date">2009-11-30</date>
+    <original-date type="date">2009-11-28</original-date>
+    <amount type="float">-12.34</amount>
+    <display-name>Harvest Co-op &amp; Market</display-name>
+    <raw-name>WITHDRAW</raw-name>
+    <raw-txntype>DEBIT</raw-txntype>
+    <memo>POS 1128 1756 531470 HARVEST COOP CAMBRIDGE MA</memo>
+    <merchant>
+      <id type="integer">42</id>
+      <name>Harvest Co-op</name>
+    </merchant>
+    <tags>
+      <tag><name>food</name></tag>
+      <tag><name>groceries</name></tag>
+    </tags>
+  </txaction>"""
+
+def wesabe_export(count):
+    return "<?xml version=\"1.0\"?>\n<txactions>\n  %s\n</txactions>\n" % \
+        "\n  ".join(WESABE_TXACTION % {'guid': "guid%d" % i}
+                    for i in range(count))
+
+class TestWesabe(unittest.TestCase):
+    def test_iter_parse(self):
+        wesabe = scraper.WesabeScraper()
+        xml = wesabe_export(20)
+        expected = [wesabe.parse(stub) for stub in wesabe.tx_re.findall(xml)]
+        for size in (1, 7, 64, len(xml)):
+            chunks = (xml[i:i + size] for i in range(0, len(xml), size))
+            self.assertEqual(list(wesabe.iter_parse(chunks)), expected)
+        self.assertEqual(list(wesabe.iter_parse(StringIO.StringIO(xml))),
+                         expected)
+
+    def test_parse(self):
+        tx = scraper.WesabeScraper().parse(WESABE_TXACTION % {'guid': "g1"})
+        self.assertEqual(tx['unique_id'], "g1")
+        self.assertEqual(tx['amount'], -12.34)
+        self.assertEqual(tx['date'], "2009-11-30")
+        self.assertEqual(tx['raw']['display_name'], "Harvest Co-op & Market")
+        self.assertEqual(tx['channel'], "pos")
+        self.assertEqual(tx['vendor']['city'], "CAMBRIDGE")
+
+    def test_saved_export(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "transactions.xml")
+            with open(path, 'wb') as file:
+                file.write(wesabe_export(3))
+            wesabe = scraper.WesabeScraper()
+            txs = list(wesabe.parse_file(path))
+            self.assertEqual(txs, list(wesabe.iter_parse([wesabe_export(3)])))
+
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                scraper.main(["--from-file", path, "wesabe"])
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(json.loads(output), json.loads(json.dumps(txs)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stream(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "transactions.xml")
+            with open(path, 'wb') as file:
+                file.write(wesabe_export(3))
+            session = scraper.CurlSession()
+            self.assertEqual("".join(session.stream("file://" + path)),
+                             wesabe_export(3))
+            session.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+LOGIN_PAGE = """<html><body><form id="form-login">
+<input type="hidden" name="task" value="L" />
+<input type="text" name="username" value="" />
+</form></body></html>"""
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Plays mint.com and wesabe.com for the account fetcher. """
+    protocol_version = "HTTP/1.1"
+    password = "secret"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, code, body="", headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/login.event":
+            self.respond(200, LOGIN_PAGE)
+        elif self.path == "/overview.event":
+            self.respond(200, "Welcome")
+        elif self.path.rstrip("?") == "/transactionDownload.event":
+            if self.headers.get("Cookie", "").startswith("user="):
+                self.respond(200, MINT_CSV)
+            else:
+                self.respond(403, "Log in first")
+        elif self.path == "/transactions.xml":
+            auth = self.headers.get("Authorization", "").split(" ")[-1]
+            if base64.b64decode(auth).endswith(":" + self.password):
+                self.respond(200, wesabe_export(3))
+            else:
+                self.respond(401, "Unauthorized")
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        form = urlparse.parse_qs(body)
+        headers = [("Location", "/overview.event")]
+        if form.get("password") == [self.password] and "task" in form:
+            headers.append(("Set-Cookie", "user=%s" % form["username"][0]))
+        self.respond(302, "", headers)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+def serve(handler):
+    """ Start a StandInServer for ``handler`` on a free local port. """
+    server = StandInServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+def stand_in_providers(base):
+    """ Scraper classes for mint and wesabe pointed at ``base``. """
+    class Mint(scraper.MintScraper):
+        login_url = base + "/login.event"
+        login_post_url = base + "/loginUserSubmit.xevent"
+        csv_url = base + "/transactionDownload.event?"
+
+    class Wesabe(scraper.WesabeScraper):
+        transactions_url = base + "/transactions.xml"
+
+    return {'mint': Mint, 'wesabe': Wesabe}
+
+class TestAccounts(unittest.TestCase):
+    def setUp(self):
+        self.server, base = serve(StandInHandler)
+        self.providers = stand_in_providers(base)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, jobs, workers):
+        results = list(scraper.iter_accounts(jobs, workers, self.providers))
+        return [result for index, result in
+                sorted((result['job'], result) for result in results)]
+
+    def test_accounts(self):
+        jobs = [("mint", "alice", "secret"), ("wesabe", "bob", "secret"),
+                ("mint", "carol", "wrong"), ("wesabe", "dave", "wrong"),
+                ("nowhere", "eve", "secret")]
+        results = self.fetch(jobs, 3)
+        self.assertEqual([r['username'] for r in results],
+                         ["alice", "bob", "carol", "dave", "eve"])
+        mint = scraper.MintScraper()
+        self.assertEqual(results[0]['transactions'],
+                list(mint.iter_parse(MINT_CSV.splitlines(True))))
+        self.assertEqual(len(results[1]['transactions']), 3)
+        for result in results[:2]:
+            self.assertEqual(result['error'], None)
+        for result in results[2:]:
+            self.assertEqual(result['transactions'], None)
+            self.assertTrue(result['error'])
+        for result in results:
+            self.assertTrue(result['seconds'] >= 0)
+
+    def test_cookies_per_job(self):
+        # The second job must not ride on the first one's login.
+        results = self.fetch([("mint", "alice", "secret"),
+                              ("mint", "carol", "wrong")], 1)
+        self.assertEqual(results[0]['error'], None)
+        self.assertTrue("403" in results[1]['error'])
+
+    def test_connection_reuse(self):
+        results = self.fetch([("wesabe", "bob", "secret")] * 3 +
+                             [("mint", "alice", "secret")] * 2, 1)
+        self.assertEqual([r['error'] for r in results], [None] * 5)
+        self.assertEqual(self.server.connections, 1)
+
+class TagServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ A stub tagging server: echoes the params it is sent. """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, code, body=""):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply(self, query):
+        self.server.requests += 1
+        if self.server.failures:
+            self.server.failures -= 1
+            return self.respond(503, "Try again")
+        if not self.path.startswith("/tags/api"):
+            return self.respond(404)
+        params = json.loads(urlparse.parse_qs(query)['params'][0])
+        if isinstance(params, list):
+            results = [{'tags': p} for p in params]
+            if self.server.drop_results:
+                del results[-self.server.drop_results:]
+            self.respond(200, json.dumps(results))
+        elif params == {'name': "nobody"}:
+            self.respond(200, "[]")
+        else:
+            self.respond(200, json.dumps({'tags': params}))
+
+    def do_GET(self):
+        self.reply(urlparse.urlsplit(self.path).query)
+
+    def do_POST(self):
+        self.reply(self.rfile.read(int(self.headers["Content-Length"])))
+
+class IdleTimeoutHandler(TagServerHandler):
+    """ A stub tagging server that closes connections idle for 0.3s. """
+    timeout = 0.3
+
+class TagServerTestCase(unittest.TestCase):
+    handler = TagServerHandler
+
+    def setUp(self):
+        self.server, self.url = serve(self.handler)
+        self.server.requests = self.server.failures = 0
+        self.server.drop_results = 0
+        self.url += "/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        return grocktx_server_client.Client(self.url, **kwargs)
+
+class TestServerClient(TagServerTestCase):
+    def test_find_put(self):
+        client = self.client()
+        self.assertEqual(json.loads(client.find({'name': "fedco"})),
+                         {'tags': {'name': "fedco"}})
+        self.assertEqual(json.loads(client.put({'name': "fedco"})),
+                         {'tags': {'name': "fedco"}})
+        self.assertEqual(self.server.connections, 1)
+        stats = client.stats()
+        self.assertEqual((stats['calls'], stats['retries'], stats['errors']),
+                         (2, 0, 0))
+        self.assertTrue(stats['max'] >= stats['p50'] > 0)
+
+    def test_many(self):
+        client = self.client(connections=3)
+        queries = [{'name': str(i)} for i in range(20)]
+        results = client.find_many(queries)
+        self.assertEqual([json.loads(r)['tags'] for r in results], queries)
+        results = client.put_many(queries)
+        self.assertEqual([json.loads(r)['tags'] for r in results], queries)
+        self.assertTrue(self.server.connections <= 3)
+        self.assertEqual(client.stats()['calls'], 40)
+
+    def test_batch(self):
+        client = self.client(batch_size=5)
+        queries = [{'name': str(i)} for i in range(12)]
+        results = client.find_many(queries)
+        self.assertEqual([json.loads(r)['tags'] for r in results], queries)
+        self.assertEqual(self.server.requests, 3)
+        # A short answer is an error, not results for the wrong queries.
+        self.server.drop_results = 1
+        cache = grocktx_server_client.TagCache(":memory:")
+        client = self.client(batch_size=5, cache=cache)
+        self.assertRaises(ValueError, client.find_many, queries)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_retries(self):
+        client = self.client(retries=2)
+        self.server.failures = 2
+        self.assertEqual(json.loads(client.find({}))['tags'], {})
+        self.assertEqual(client.stats()['retries'], 2)
+        self.server.failures = 3
+        self.assertRaises(urllib2.HTTPError, client.find, {})
+        self.assertEqual(client.stats()['errors'], 1)
+        # Client errors are not retried.
+        client.path = "/nowhere"
+        requests = self.server.requests
+        self.assertRaises(urllib2.HTTPError, client.find, {})
+        self.assertEqual(self.server.requests, requests + 1)
+
+    def test_puts_not_retried(self):
+        client = self.client(retries=2)
+        self.server.failures = 1
+        self.assertRaises(urllib2.HTTPError, client.put, {})
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(client.stats()['retries'], 0)
+
+class TestIdleConnections(TagServerTestCase):
+    handler = IdleTimeoutHandler
+
+    def test_reconnect(self):
+        client = self.client(retries=0)
+        for i in xrange(2):
+            self.assertEqual(json.loads(client.put({'name': i})),
+                             {'tags': {'name': i}})
+            self.assertEqual(json.loads(client.find({'name': i})),
+                             {'tags': {'name': i}})
+            # Let the server drop the kept-alive connection.
+            time.sleep(0.6)
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(self.server.connections, 2)
+
+class TestTagCache(TagServerTestCase):
+    def setUp(self):
+        TagServerTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "tags.db")
+        self.cache = grocktx_server_client.TagCache(self.path, ttl=100,
+                negative_ttl=10, maxsize=3)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+        TagServerTestCase.tearDown(self)
+
+    def test_cached(self):
+        client = self.client(cache=self.cache)
+        fedco = {'vendor': {'description': "FEDCO SEEDS", 'state': "ME"}}
+        result = client.find(fedco)
+        same = {'vendor': {'description': " fedco  seeds", 'state': "ME",
+                           'zip': ""}}
+        self.assertEqual(client.find(same), result)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(client.find({'name': "nobody"}), "[]")
+        self.assertEqual(client.find({'name': "nobody"}), "[]")
+        self.assertEqual(self.server.requests, 2)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'],
+                          stats['misses']), (2, 1, 2))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+        # Entries persist.
+        self.cache.close()
+        self.cache = grocktx_server_client.TagCache(self.path)
+        self.assertEqual(self.cache.get(fedco), result)
+
+    def test_ttl(self):
+        now = time.time()
+        self.cache.clock = lambda: now
+        self.cache.put({'name': "fedco"}, '{"tags": []}')
+        self.cache.put({'name': "nobody"}, '[]')
+        self.cache.clock = lambda: now + 50
+        self.assertEqual(self.cache.get({'name': "fedco"}), '{"tags": []}')
+        self.assertEqual(self.cache.get({'name': "nobody"}), None)
+        self.cache.clock = lambda: now + 150
+        self.assertEqual(self.cache.get({'name': "fedco"}), None)
+        self.assertEqual(self.cache.stats()['expired'], 2)
+
+    def test_eviction(self):
+        for i in range(5):
+            self.cache.put({'name': str(i)}, '{"tags": %d}' % i)
+        stats = self.cache.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (3, 2))
+        self.assertEqual(self.cache.get({'name': "0"}), None)
+        self.assertEqual(self.cache.get({'name': "4"}), '{"tags": 4}')
+        # Replacing an entry doesn't make room.
+        self.cache.put({'name': "4"}, '{"tags": 5}')
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+        self.cache.invalidate({'name': "4"})
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.cache.close()
+        self.cache = grocktx_server_client.TagCache(self.path, maxsize=3)
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+    def test_find_many(self):
+        self.cache.maxsize = 100
+        client = self.client(cache=self.cache)
+        queries = [{'name': str(i % 4)} for i in range(10)]
+        results = client.find_many(queries)
+        self.assertEqual([json.loads(r)['tags'] for r in results],
+                         [{'name': str(i % 4)} for i in range(10)])
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(client.find_many(queries), results)
+        self.assertEqual(self.server.requests, 4)
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.scrape_server, base = serve(StandInHandler)
+        self.providers = stand_in_providers(base)
+        self.tag_server, url = serve(TagServerHandler)
+        self.tag_server.requests = self.tag_server.failures = 0
+        self.tag_server.drop_results = 0
+        self.client = grocktx_server_client.Client(url + "/", backoff=0)
+
+    def tearDown(self):
+        for server in (self.scrape_server, self.tag_server):
+            server.shutdown()
+            server.server_close()
+
+    def enrich(self, jobs, **kwargs):
+        stats = {}
+        txs = pipeline.enrich(jobs, client=self.client, stats=stats,
+                              providers=self.providers, **kwargs)
+        return sorted(txs, key=lambda tx: tx['unique_id']), stats
+
+    def test_enrich(self):
+        jobs = [("mint", "alice", "secret"), ("wesabe", "bob", "secret"),
+                ("mint", "carol", "wrong")]
+        txs, stats = self.enrich(jobs, fetch_workers=2, tag_concurrency=3,
+                                 queue_size=2)
+        expected = list(scraper.MintScraper().iter_parse(
+                MINT_CSV.splitlines(True)))
+        expected += list(scraper.WesabeScraper().iter_parse(
+                [wesabe_export(3)]))
+        expected.sort(key=lambda tx: tx['unique_id'])
+        self.assertEqual(len(txs), 6)
+        for tx, parsed in zip(txs, expected):
+            tags = tx.pop('tags')
+            self.assertEqual(tx, parsed)
+            if tx['channel'] in pipeline.TAGGED_CHANNELS:
+                self.assertEqual(tags, {'tags': {'vendor': tx['vendor']}})
+            else:
+                self.assertEqual(tags, None)
+        self.assertEqual((stats['fetched'], stats['parsed'], stats['tagged']),
+                         (6, 6, 6))
+        self.assertEqual(len(stats['errors']), 1)
+        self.assertTrue(stats['errors'][0].startswith("mint carol"))
+
+    def test_tag_errors(self):
+        self.tag_server.failures = 100
+        self.client.retries = 0
+        txs, stats = self.enrich([("wesabe", "bob", "secret")])
+        self.assertEqual([tx['tags'] for tx in txs], [None] * 3)
+        self.assertEqual(len(stats['errors']), 3)
+
+    def test_parse_workers(self):
+        txs, stats = self.enrich([("wesabe", "bob", "secret")] * 2,
+                                 parse_workers=2, chunksize=2)
+        self.assertEqual(len(txs), 6)
+        self.assertEqual(stats['errors'], [])
+
+    def threads(self):
+        return [thread for thread in threading.enumerate()
+                if thread.name.startswith("enrich-")]
+
+    def wait_for_threads(self):
+        deadline = time.time() + 5
+        while self.threads() and time.time() < deadline:
+            time.sleep(0.05)
+        return self.threads()
+
+    def test_stop_early(self):
+        txs = pipeline.enrich([("wesabe", "bob", "secret")] * 20,
+                              client=self.client, providers=self.providers,
+                              fetch_workers=2, queue_size=1)
+        txs.next()
+        self.assertTrue(self.threads())
+        txs.close()
+        self.assertEqual(self.wait_for_threads(), [])
+
+    def test_parse_failure(self):
+        def fail(memos, dates):
+            raise ValueError("unparseable")
+        parse_many = parser.parse_many
+        parser.parse_many = fail
+        try:
+            self.assertRaises(ValueError, self.enrich,
+                    [("wesabe", "bob", "secret")] * 20, queue_size=1)
+        finally:
+            parser.parse_many = parse_many
+        self.assertEqual(self.wait_for_threads(), [])
+
 class TestScraper(unittest.TestCase):
     def setUp(self):
         # Hardcode values for usernames and passwords here to avoid prompts.
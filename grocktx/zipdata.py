@@ -0,0 +1,498 @@
+"""
+Zip code and city tables used by ``grocktx.parser`` to recognize the location
+at the end of a vendor description.
+
+The tables are read from ``data/zips.csv``.  Parsing the csv text is slow, so
+the parsed tables are also kept in a marshal file next to it,
+``data/zips.marshal``, along with a checksum of the csv they were built from.
+The marshal file is used whenever its checksum matches the csv, and rebuilt
+(if the data directory is writable) whenever it doesn't.
+
+``MappedZipData`` is a read-only alternative that keeps the same tables in
+one memory-mapped file, ``data/zips.map``, so that pre-forked workers share
+them instead of each holding a copy.  Select it with
+``preload(MappedZipData)``.
+
+To regenerate the marshal and map files, e.g. after updating the csv:
+    $ python -m grocktx.zipdata
+"""
+import os
+import gc
+import csv
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import marshal
+import tempfile
+import itertools
+import threading
+import StringIO
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+class CityIndex(object):
+    """
+    The cities of one state, deduplicated and grouped by name length so that
+    ``parse_city`` can score each length's candidate stub once and skip whole
+    groups of cities that cannot beat the best score found so far.
+    """
+    def __init__(self, cities):
+        self.groups = {}
+        rank = 0
+        seen = set()
+        for city in cities:
+            if city in seen:
+                continue
+            seen.add(city)
+            self.groups.setdefault(len(city), []).append((rank, city))
+            rank += 1
+        self.lengths = sorted(self.groups.keys())
+
+    @classmethod
+    def from_groups(cls, groups):
+        """ Rebuild an index from the ``groups`` of an existing one. """
+        index = cls(())
+        index.groups = groups
+        index.lengths = sorted(groups.keys())
+        return index
+
+class ZipData(object):
+    ZIP_CITY_DATA = os.path.join(DATA_DIR, "zips.csv")
+    ZIP_CITY_CACHE = os.path.join(DATA_DIR, "zips.marshal")
+    # Bump when the layout of the cached tables changes.
+    CACHE_FORMAT = 2
+
+    def __init__(self, use_cache=True):
+        """
+        Load the tables from the marshal cache if it is up to date, otherwise
+        from the csv.  With ``use_cache=False`` the csv is always read and
+        the cache is left alone.
+        """
+        with open(self.ZIP_CITY_DATA, 'rb') as file:
+            data = file.read()
+        self.checksum = hashlib.sha1(data).hexdigest()
+
+        tables = None
+        if use_cache:
+            tables = self._read_cache()
+        if tables is None:
+            tables = self._read_csv(data)
+            if use_cache:
+                self._write_cache(tables)
+        self.rows, self.cities_by_zip, self.cities_by_state, groups = tables
+
+        self.city_index_by_state = {}
+        for state, state_groups in groups.iteritems():
+            self.city_index_by_state[state] = CityIndex.from_groups(
+                    state_groups)
+
+    def _read_csv(self, data):
+        cities_by_state = {}
+        cities_by_zip = {}
+        rows = 0
+        seen_by_state = {}
+        reader = csv.reader(StringIO.StringIO(data))
+        for zip, city, state in reader:
+            rows += 1
+            city = intern(city)
+            arr = cities_by_zip.get(zip, [])
+            arr.append(city)
+            cities_by_zip[zip] = arr
+
+            seen = seen_by_state.get(state, None)
+            if seen is None:
+                seen = seen_by_state[state] = set()
+                cities_by_state[state] = []
+            if city not in seen:
+                seen.add(city)
+                cities_by_state[state].append(city)
+        groups = {}
+        for state, cities in cities_by_state.iteritems():
+            groups[state] = CityIndex(cities).groups
+        return rows, cities_by_zip, cities_by_state, groups
+
+    def _read_cache(self):
+        """
+        Return the cached tables, or None if the cache is missing, unreadable
+        or was built from a different csv.  Interned strings stay interned
+        (and shared) through marshal.
+        """
+        # The tables are tens of thousands of small lists; don't let the
+        # cyclic garbage collector walk them repeatedly while they load.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            try:
+                with open(self.ZIP_CITY_CACHE, 'rb') as file:
+                    cached = marshal.load(file)
+            except (IOError, EOFError, ValueError, TypeError):
+                return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if not isinstance(cached, tuple) or len(cached) != 3 or \
+                cached[:2] != (self.CACHE_FORMAT, self.checksum):
+            return None
+        return cached[2]
+
+    def _write_cache(self, tables):
+        """
+        Write the tables to the cache.  Returns False if the data directory
+        is not writable (e.g. a system-wide install); the csv is then simply
+        parsed on every load.
+        """
+        tmp = "%s.%s.tmp" % (self.ZIP_CITY_CACHE, os.getpid())
+        try:
+            with open(tmp, 'wb') as file:
+                marshal.dump((self.CACHE_FORMAT, self.checksum, tables), file)
+            os.rename(tmp, self.ZIP_CITY_CACHE)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        return True
+
+    @classmethod
+    def build_cache(cls):
+        """ Rebuild the marshal cache from the csv, even if it is current. """
+        data = cls(use_cache=False)
+        groups = {}
+        for state, index in data.city_index_by_state.iteritems():
+            groups[state] = index.groups
+        if not data._write_cache((data.rows, data.cities_by_zip,
+                data.cities_by_state, groups)):
+            raise IOError("Can't write %s" % cls.ZIP_CITY_CACHE)
+        return data
+
+    def counts(self):
+        """
+        Return the size of the tables: csv rows read, zips, states, unique
+        (state, city) pairs and unique city names.
+        """
+        names = set()
+        for cities in self.cities_by_state.itervalues():
+            names.update(cities)
+        return {
+            'rows': self.rows,
+            'zips': len(self.cities_by_zip),
+            'states': len(self.cities_by_state),
+            'state_cities': sum(len(c) for c in self.cities_by_state.values()),
+            'city_names': len(names),
+        }
+
+    def city_index(self, state):
+        """ Return the ``CityIndex`` for ``state``, or None. """
+        return self.city_index_by_state.get(state, None)
+
+    def zip_city(self, zip):
+        """ Return the first city listed for ``zip``, or "". """
+        return self.cities_by_zip.get(zip, [""])[0]
+
+class _MappedGroup(object):
+    """
+    The cities of one length in one state, read from the map on demand.  Acts
+    like the list of (rank, city) pairs in ``CityIndex.groups``.
+    """
+    def __init__(self, map, length, count, ranks_offset, names_offset):
+        self.map = map
+        self.length = length
+        self.count = count
+        self.ranks_offset = ranks_offset
+        self.names_offset = names_offset
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        rank = struct.unpack_from("<I", self.map, self.ranks_offset + i * 4)[0]
+        start = self.names_offset + i * self.length
+        return rank, self.map[start:start + self.length]
+
+    def __iter__(self):
+        ranks = struct.unpack_from("<%dI" % self.count, self.map,
+                self.ranks_offset)
+        # Every name in a group has the same length, so the names are
+        # stored back to back without separators.
+        length = self.length
+        names = self.map[self.names_offset:
+                         self.names_offset + self.count * length]
+        return itertools.izip(ranks,
+            (names[i:i + length] for i in xrange(0, len(names), length)))
+
+class MappedCityIndex(CityIndex):
+    """ A ``CityIndex`` whose groups live in a ``MappedZipData`` map. """
+    def __init__(self, groups):
+        self.groups = groups
+        self.lengths = sorted(groups.keys())
+
+class MappedZipData(object):
+    """
+    A read-only alternative to ``ZipData`` that keeps the tables in one
+    memory-mapped file, ``data/zips.map``, instead of Python dicts and lists.
+    Pre-forked workers (and separate processes mapping the same file) share
+    its pages rather than each holding a copy of the tables.
+
+    Layout, all integers little-endian:
+        header
+        zip entries, sorted by zip:     zip, city offset, city length
+        state entries, sorted by state: state, first group, end group
+        group entries:                  city length, count, ranks offset,
+                                        names offset
+        ranks of each group's cities, uint32
+        names of each group's cities, fixed width within a group
+        first city name of each zip
+    Zips are found by binary search over the fixed width zip entries.
+    """
+    ZIP_CITY_DATA = ZipData.ZIP_CITY_DATA
+    ZIP_CITY_MAP = os.path.join(DATA_DIR, "zips.map")
+    MAGIC = "GTXZIP01"
+    # magic, csv checksum, rows, zips, states, groups, state cities,
+    # unique city names
+    HEADER = struct.Struct("<8s40s6I")
+    ZIP_ENTRY = struct.Struct("<5sIB")
+    STATE_ENTRY = struct.Struct("<2sII")
+    GROUP_ENTRY = struct.Struct("<HIII")
+
+    def __init__(self):
+        with open(self.ZIP_CITY_DATA, 'rb') as file:
+            self.checksum = hashlib.sha1(file.read()).hexdigest()
+        self.map = self._open_map()
+        if self.map is None:
+            self.map = self._build_map()
+
+        (magic, checksum, self.rows, self.num_zips, self.num_states,
+                self.num_groups, self.state_cities, self.city_names) = \
+                self.HEADER.unpack_from(self.map, 0)
+        self.zips_offset = self.HEADER.size
+        self.states_offset = self.zips_offset + \
+                self.num_zips * self.ZIP_ENTRY.size
+        self.groups_offset = self.states_offset + \
+                self.num_states * self.STATE_ENTRY.size
+        self.city_index_by_state = {}
+        self._lock = threading.Lock()
+
+    def _open_map(self):
+        """ Map the existing file; None if it is missing or stale. """
+        try:
+            file = open(self.ZIP_CITY_MAP, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                return None
+        finally:
+            file.close()
+        if len(map) < self.HEADER.size or \
+                self.HEADER.unpack_from(map, 0)[:2] != \
+                (self.MAGIC, self.checksum):
+            map.close()
+            return None
+        return map
+
+    def _build_map(self):
+        """
+        Write a fresh map file from the csv and map it.  If the data directory
+        is not writable, the map is built in an anonymous temporary file,
+        which is still shared with any workers forked after loading.
+        """
+        data = self.serialize(ZipData())
+        try:
+            self._write_map(data)
+            file = open(self.ZIP_CITY_MAP, 'rb')
+        except (IOError, OSError):
+            file = tempfile.TemporaryFile()
+            file.write(data)
+            file.flush()
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+
+    @classmethod
+    def _write_map(cls, data):
+        # Write and rename, so processes that already have the old file
+        # mapped keep a consistent view of it.
+        tmp = "%s.%s.tmp" % (cls.ZIP_CITY_MAP, os.getpid())
+        try:
+            with open(tmp, 'wb') as file:
+                file.write(data)
+            os.rename(tmp, cls.ZIP_CITY_MAP)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def serialize(cls, zip_data):
+        """ Return the contents of a map file for the given ``ZipData``. """
+        zip_names = []
+        zip_name_offsets = {}
+        zip_names_length = 0
+        zip_entries = []
+        for zip in sorted(zip_data.cities_by_zip.keys()):
+            city = zip_data.cities_by_zip[zip][0]
+            if city not in zip_name_offsets:
+                zip_name_offsets[city] = zip_names_length
+                zip_names.append(city)
+                zip_names_length += len(city)
+            zip_entries.append((zip, zip_name_offsets[city], len(city)))
+
+        states = sorted(zip_data.city_index_by_state.keys())
+        groups = []
+        state_entries = []
+        for state in states:
+            index = zip_data.city_index_by_state[state]
+            first = len(groups)
+            for length in index.lengths:
+                groups.append((length, index.groups[length]))
+            state_entries.append((state, first, len(groups)))
+
+        ranks_offset = cls.HEADER.size + \
+                len(zip_entries) * cls.ZIP_ENTRY.size + \
+                len(state_entries) * cls.STATE_ENTRY.size + \
+                len(groups) * cls.GROUP_ENTRY.size
+        names_offset = ranks_offset + \
+                sum(len(members) for length, members in groups) * 4
+        zip_names_offset = names_offset + \
+                sum(length * len(members) for length, members in groups)
+
+        counts = zip_data.counts()
+        out = [cls.HEADER.pack(cls.MAGIC, zip_data.checksum, counts['rows'],
+                len(zip_entries), len(state_entries), len(groups),
+                counts['state_cities'], counts['city_names'])]
+        for zip, offset, length in zip_entries:
+            out.append(cls.ZIP_ENTRY.pack(zip, zip_names_offset + offset,
+                length))
+        for state, first, end in state_entries:
+            out.append(cls.STATE_ENTRY.pack(state, first, end))
+        ranks = array.array("I")
+        names = []
+        for length, members in groups:
+            out.append(cls.GROUP_ENTRY.pack(length, len(members),
+                ranks_offset + len(ranks) * 4, names_offset))
+            ranks.extend(rank for rank, city in members)
+            names.extend(city for rank, city in members)
+            names_offset += length * len(members)
+        if sys.byteorder != "little":
+            ranks.byteswap()
+        out.append(ranks.tostring())
+        out.extend(names)
+        out.extend(zip_names)
+        return "".join(out)
+
+    @classmethod
+    def build_map(cls):
+        """ Rebuild the map file from the csv, even if it is current. """
+        cls._write_map(cls.serialize(ZipData()))
+
+    def counts(self):
+        """ Return the size of the tables, as ``ZipData.counts``. """
+        return {
+            'rows': self.rows,
+            'zips': self.num_zips,
+            'states': self.num_states,
+            'state_cities': self.state_cities,
+            'city_names': self.city_names,
+        }
+
+    def _find_state(self, state):
+        lo, hi = 0, self.num_states
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry, first, end = self.STATE_ENTRY.unpack_from(self.map,
+                    self.states_offset + mid * self.STATE_ENTRY.size)
+            if entry < state:
+                lo = mid + 1
+            elif entry > state:
+                hi = mid
+            else:
+                return first, end
+        return None
+
+    def city_index(self, state):
+        """ Return the ``CityIndex`` for ``state``, or None. """
+        try:
+            return self.city_index_by_state[state]
+        except KeyError:
+            pass
+        with self._lock:
+            if state in self.city_index_by_state:
+                return self.city_index_by_state[state]
+            found = self._find_state(state)
+            index = None
+            if found:
+                groups = {}
+                for i in xrange(*found):
+                    length, count, ranks_offset, names_offset = \
+                        self.GROUP_ENTRY.unpack_from(self.map,
+                            self.groups_offset + i * self.GROUP_ENTRY.size)
+                    groups[length] = _MappedGroup(self.map, length, count,
+                            ranks_offset, names_offset)
+                index = MappedCityIndex(groups)
+            self.city_index_by_state[state] = index
+            return index
+
+    def zip_city(self, zip):
+        """ Return the first city listed for ``zip``, or "". """
+        size = self.ZIP_ENTRY.size
+        lo, hi = 0, self.num_zips
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.zips_offset + mid * size
+            entry = self.map[start:start + 5]
+            if entry < zip:
+                lo = mid + 1
+            elif entry > zip:
+                hi = mid
+            else:
+                entry, offset, length = self.ZIP_ENTRY.unpack_from(self.map,
+                        start)
+                return self.map[offset:offset + length]
+        return ""
+
+_zip_data = None
+_zip_data_lock = threading.Lock()
+
+def zip_data():
+    """
+    Return the shared ``ZipData``, loading it on first use.  Memos that never
+    reach ``parse_vendor`` (checks, deposits, transfers...) never pay for it.
+    """
+    global _zip_data
+    if _zip_data is None:
+        with _zip_data_lock:
+            if _zip_data is None:
+                _zip_data = ZipData()
+    return _zip_data
+
+def preload(backend=ZipData):
+    """
+    Load the zip/city tables now rather than on the first parse, e.g. in a
+    server before forking workers.  Pass ``backend=MappedZipData`` to use
+    the memory-mapped tables, which forked workers share.
+    """
+    global _zip_data
+    with _zip_data_lock:
+        if not isinstance(_zip_data, backend):
+            _zip_data = backend()
+    return _zip_data
+
+if __name__ == "__main__":
+    try:
+        data = ZipData.build_cache()
+        MappedZipData.build_map()
+    except (IOError, OSError), e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    print "Wrote %s and %s: %s" % (ZipData.ZIP_CITY_CACHE,
+            MappedZipData.ZIP_CITY_MAP, data.counts())